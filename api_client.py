@@ -1,53 +1,235 @@
 import datetime
+import json
+import logging
+import threading
 import time
-from typing import Dict, Iterable
+from typing import Any, Callable, Dict, Iterable, Mapping, Optional, Tuple, TypeVar
 
 import requests
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+import transport
+from cache import Cache
 from config import *
+from metadata_store import MetadataStore, Snapshot, digest
 from models import exchanges, pies, instruments
-from utils import cached_method
+from models.accounts import Account
+from utils import now
 
 __all__ = [
     'T212ApiClient',
 ]
 
+T = TypeVar('T')
+
+
+class _MetadataContentMissing(Exception):
+    pass
+
 
 class T212ApiClient:
-    def __init__(self):
-        self._endpoint = f'https://{MODE.name.lower()}.trading212.com'
-        self._session = requests.session()
+    PIE_RATE_LIMIT = datetime.timedelta(seconds=5)
+    PIE_RESCAN_INTERVAL = datetime.timedelta(hours=1)
+    METADATA_TTL = datetime.timedelta(hours=3)
+
+    def __init__(self, account: Account, metadata_store: Optional[MetadataStore] = None):
+        self.account = account
+        self._endpoint = account.base_url
+        self._session = transport.new_session()
         self._session.headers.update({
-            'Authorization': T212_TOKEN,
+            'Authorization': account.token,
         })
 
-    def get_pies(self) -> Iterable[pies.Pie]:
-        _pies = self._get('/api/v0/equity/pies')
-        for pie in _pies:
-            time.sleep(5)  # rate limiting
-            yield pies.Pie.from_dict(self._get_pie(pie['id']))
+        # Pie name index, pie details are only fetched for ids not seen before.
+        # The client is shared by all plans of the account, scans are serialized
+        # so that the pie rate limit holds across them.
+        self._pie_lock = threading.Lock()
+        self._pie_scan_lock = threading.Lock()
+        self._pie_ids: Tuple[int, ...] = ()
+        self._pie_names: Dict[int, str] = {}
+        self._pie_scanned_at: Optional[datetime.datetime] = None
+
+        # Metadata snapshots survive restarts, decoded values are kept per snapshot digest.
+        # Response bodies are only read from disk when a snapshot has to be decoded.
+        self._metadata_store = metadata_store or MetadataStore.for_mode(account.mode)
+        self._metadata_lock = threading.Lock()
+        self._metadata_snapshots: Dict[str, Snapshot] = {}
+        self._metadata_decoded: Cache[Tuple[str, str], Any] = Cache('T212ApiClient.metadata', maxsize=6)
+        self._metadata_refreshing = set()
+
+    def get_pie_index(self) -> Dict[str, int]:
+        pie_ids = tuple(sorted(p['id'] for p in self._get('/api/v0/equity/pies')))
+        with self._pie_scan_lock:
+            if pie_ids != self._pie_ids:
+                logging.info('pie listing has changed, updating pie index')
+                with self._pie_lock:
+                    self._pie_names = {pie_id: name for pie_id, name in self._pie_names.items() if pie_id in pie_ids}
+                    new_pie_ids = [pie_id for pie_id in pie_ids if pie_id not in self._pie_names]
+                self._scan_pies(new_pie_ids)
+                with self._pie_lock:
+                    if not self._pie_ids:
+                        self._pie_scanned_at = now()
+                    self._pie_ids = pie_ids
+        return self._pie_index()
+
+    def get_pie(self, name: str) -> Optional[pies.Pie]:
+        pie_id = self.get_pie_index().get(name)
+        if pie_id is None:
+            with self._pie_scan_lock:
+                # Another caller might have rescanned in the meantime.
+                if (pie_id := self._pie_index().get(name)) is None and self._pie_rescan_due():
+                    # A pie might have been renamed, which isn't visible in the listing.
+                    logging.info('"%s" pie is not in the index, rescanning all pies', name)
+                    self._scan_pies(list(self._pie_ids))
+                    with self._pie_lock:
+                        self._pie_scanned_at = now()
+                    pie_id = self._pie_index().get(name)
+        if pie_id is None:
+            return None
 
-    def find_pie(self, name: str) -> pies.Pie:
-        for pie in self.get_pies():
-            if pie.settings.name == name:
-                return pie
+        pie = pies.Pie.from_dict(self._get_pie(pie_id))
+        with self._pie_lock:
+            self._pie_names[pie_id] = pie.settings.name
+        if pie.settings.name != name:
+            logging.info('pie %s was renamed to "%s"', pie_id, pie.settings.name)
+            return None
+        return pie
+
+    def indexed_pie_id(self, name: str, pie_ids: Iterable[int]) -> Optional[int]:
+        # Resolves a pie id without any requests if the index is up to date with the listing.
+        with self._pie_lock:
+            if tuple(sorted(pie_ids)) != self._pie_ids:
+                return None
+        return self._pie_index().get(name)
+
+    def find_pie(self, name: str) -> Optional[pies.Pie]:
+        return self.get_pie(name)
 
-    @cached_method(ttl=datetime.timedelta(hours=3))
     def get_exchange_info(self) -> Dict[int, exchanges.Exchange]:
-        _exchanges = self._get('/api/v0/equity/metadata/exchanges')
-        return {e['id']: exchanges.Exchange.from_dict(e) for e in _exchanges}
+        return self._metadata(
+            'exchanges', '/api/v0/equity/metadata/exchanges',
+            lambda content: {e['id']: exchanges.Exchange.from_dict(e) for e in json.loads(content)},
+        )
+
+    def get_working_schedules(self) -> Mapping[int, exchanges.ScheduleIndex]:
+        # Same snapshot as get_exchange_info, packed for the scheduler.
+        return self._metadata('exchanges', '/api/v0/equity/metadata/exchanges', exchanges.WorkingSchedules, view='schedules')
 
-    @cached_method(ttl=datetime.timedelta(hours=3))
-    def get_instrument_info(self) -> Dict[str, instruments.Instrument]:
-        _instruments = self._get('/api/v0/equity/metadata/instruments')
-        return {i['ticker']: instruments.Instrument.from_dict(i) for i in _instruments}
+    def get_instrument_info(self) -> Mapping[str, instruments.Instrument]:
+        return self._metadata('instruments', '/api/v0/equity/metadata/instruments', instruments.InstrumentIndex)
 
-    @retry(reraise=True, stop=stop_after_attempt(15), wait=wait_exponential(max=60))
+    def metadata_version(self) -> Tuple[Tuple[str, int], ...]:
+        with self._metadata_lock:
+            return tuple(sorted((k, s.version) for k, s in self._metadata_snapshots.items()))
+
+    def refresh_metadata(self):
+        self._refresh_metadata('exchanges', '/api/v0/equity/metadata/exchanges')
+        self._refresh_metadata('instruments', '/api/v0/equity/metadata/instruments')
+
+    @retry(reraise=True, stop=stop_after_attempt(15), wait=wait_exponential(max=60), before_sleep=transport.record_retry)
     def _get(self, path):
         r = self._session.get(f'{self._endpoint}{path}')
         r.raise_for_status()
         return r.json()
 
+    @retry(reraise=True, stop=stop_after_attempt(15), wait=wait_exponential(max=60), before_sleep=transport.record_retry)
+    def _get_conditional(self, path: str, snapshot: Optional[Snapshot]) -> requests.Response:
+        headers = {}
+        if snapshot and snapshot.etag:
+            headers['If-None-Match'] = snapshot.etag
+        if snapshot and snapshot.last_modified:
+            headers['If-Modified-Since'] = snapshot.last_modified
+        r = self._session.get(f'{self._endpoint}{path}', headers=headers)
+        r.raise_for_status()
+        return r
+
+    def _metadata(self, key: str, path: str, decode: Callable[[str], T], view: str = '') -> T:
+        with self._metadata_lock:
+            snapshot = self._metadata_snapshots.get(key)
+            if snapshot is None and (snapshot := self._metadata_store.load(key)):
+                logging.info('loaded %s metadata snapshot v%s from disk', key, snapshot.version)
+                self._metadata_snapshots[key] = snapshot
+
+        if snapshot is None:
+            snapshot = self._refresh_metadata(key, path)
+        elif now() - snapshot.fetched_at > self.METADATA_TTL:
+            self._refresh_metadata_in_background(key, path)
+
+        def load():
+            content = self._metadata_store.load_content(key, snapshot)
+            if content is None:
+                raise _MetadataContentMissing()
+            return decode(content)
+
+        # Views are different decodings of the same snapshot.
+        name = f'{key}/{view}' if view else key
+        try:
+            return self._metadata_decoded.get((name, snapshot.digest), load)
+        except _MetadataContentMissing:
+            logging.warning('%s metadata content is missing, downloading it again', key)
+            snapshot = self._refresh_metadata(key, path, force=True)
+            return self._metadata_decoded.get((name, snapshot.digest), load)
+
+    def _refresh_metadata(self, key: str, path: str, force: bool = False) -> Snapshot:
+        with self._metadata_lock:
+            snapshot = self._metadata_snapshots.get(key)
+
+        r = self._get_conditional(path, None if force else snapshot)
+        if not force and snapshot and (r.status_code == 304 or digest(r.content) == snapshot.digest):
+            logging.info('%s metadata has not changed', key)
+            snapshot = Snapshot(
+                digest=snapshot.digest,
+                version=snapshot.version,
+                fetched_at=now(),
+                etag=r.headers.get('ETag', snapshot.etag),
+                last_modified=r.headers.get('Last-Modified', snapshot.last_modified),
+            )
+            self._metadata_store.save(key, snapshot)
+        else:
+            snapshot = Snapshot(
+                digest=digest(r.content),
+                version=snapshot.version + 1 if snapshot else 1,
+                fetched_at=now(),
+                etag=r.headers.get('ETag'),
+                last_modified=r.headers.get('Last-Modified'),
+            )
+            logging.info('%s metadata has changed, storing snapshot v%s', key, snapshot.version)
+            self._metadata_store.save(key, snapshot, r.content)
+
+        with self._metadata_lock:
+            self._metadata_snapshots[key] = snapshot
+        return snapshot
+
+    def _refresh_metadata_in_background(self, key: str, path: str):
+        def refresh():
+            try:
+                self._refresh_metadata(key, path)
+            except Exception:
+                logging.exception('failed to refresh %s metadata', key)
+            finally:
+                with self._metadata_lock:
+                    self._metadata_refreshing.discard(key)
+
+        with self._metadata_lock:
+            if key in self._metadata_refreshing:
+                return
+            self._metadata_refreshing.add(key)
+        threading.Thread(target=refresh, name=f'metadata-{key}', daemon=True).start()
+
     def _get_pie(self, pie_id: int):
         return self._get(f'/api/v0/equity/pies/{pie_id}')
+
+    def _scan_pies(self, pie_ids: Iterable[int]):
+        for i, pie_id in enumerate(pie_ids):
+            if i:
+                time.sleep(self.PIE_RATE_LIMIT.total_seconds())  # rate limiting
+            name = self._get_pie(pie_id)['settings']['name']
+            with self._pie_lock:
+                self._pie_names[pie_id] = name
+
+    def _pie_rescan_due(self) -> bool:
+        return self._pie_scanned_at is None or now() - self._pie_scanned_at > self.PIE_RESCAN_INTERVAL
+
+    def _pie_index(self) -> Dict[str, int]:
+        with self._pie_lock:
+            return {name: pie_id for pie_id, name in self._pie_names.items()}
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple, TypeVar
+
+import aiohttp
+from pytrading212 import EquityOrder, OrderType
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_not_exception_type
+
+import transport
+from api_client import T212ApiClient
+from config import *
+from equity_client import *
+from models import exchanges, instruments, orders, pies
+from utils import *
+
+__all__ = [
+    'AsyncHttp',
+    'AsyncT212ApiClient',
+    'AsyncEquityClient',
+]
+
+R = TypeVar('R')
+
+
+# Connection pool shared by all async clients, the session is bound to the
+# event loop it was first used in.
+class AsyncHttp:
+    def __init__(self, limit: int = 16, limit_per_host: int = HTTP_POOL_SIZE):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host),
+                timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+                trace_configs=[transport.aiohttp_trace_config()],
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+# Async counterpart of T212ApiClient. Pie index and metadata snapshots are
+# shared with the wrapped sync client, metadata is served from its on-disk
+# store and refreshed by its background threads.
+class AsyncT212ApiClient:
+    def __init__(self, http: AsyncHttp, client: T212ApiClient):
+        self._http = http
+        self._endpoint = client.account.base_url
+        self._token = client.account.token
+        self.client = client
+
+    async def find_pie(self, name: str) -> Optional[pies.Pie]:
+        pie_ids = [p['id'] for p in await self._get('/api/v0/equity/pies')]
+        if (pie_id := self.client.indexed_pie_id(name, pie_ids)) is not None:
+            pie = pies.Pie.from_dict(await self._get(f'/api/v0/equity/pies/{pie_id}'))
+            if pie.settings.name == name:
+                return pie
+        # Index needs updating, which is rate limited and done by the sync client.
+        return await asyncio.to_thread(self.client.get_pie, name)
+
+    async def get_exchange_info(self) -> Dict[int, exchanges.Exchange]:
+        return await asyncio.to_thread(self.client.get_exchange_info)
+
+    async def get_working_schedules(self) -> Mapping[int, exchanges.ScheduleIndex]:
+        return await asyncio.to_thread(self.client.get_working_schedules)
+
+    async def get_instrument_info(self) -> Mapping[str, instruments.Instrument]:
+        return await asyncio.to_thread(self.client.get_instrument_info)
+
+    @retry(reraise=True, stop=stop_after_attempt(15), wait=wait_exponential(max=60), before_sleep=transport.record_retry)
+    async def _get(self, path: str) -> Any:
+        async with self._http.session.get(f'{self._endpoint}{path}', headers={'Authorization': self._token}) as r:
+            r.raise_for_status()
+            return await r.json()
+
+
+# Async counterpart of EquityClient. Orders are still placed through
+# pytrading212, which is synchronous, so it runs in a worker thread.
+class AsyncEquityClient:
+    def __init__(self, http: AsyncHttp, client: EquityClient):
+        self._http = http
+        self.client = client
+        self._reconciling: Optional[asyncio.Future] = None
+
+    async def fx_rate(self, currency_from: str, currency_to: str) -> float:
+        if currency_from == currency_to:
+            return 1.0
+        pair = (currency_from, currency_to)
+        if (rate := self.client.fx_rates.get_fresh(pair)) is not None:
+            return rate
+        r = await self._api_call(
+            'POST', '/rest/trading/v1/fx-rates/conversion',
+            json={
+                'fromCurrency': currency_from,
+                'toCurrency': currency_to,
+                'amount': self.client.FX_REFERENCE_AMOUNT,
+            },
+        )
+        rate = r['value'] / self.client.FX_REFERENCE_AMOUNT
+        self.client.fx_rates.put(pair, rate)
+        return rate
+
+    async def convert(self, currency_from: str, currency_to: str, amount: float) -> float:
+        return amount * await self.fx_rate(currency_from, currency_to)
+
+    async def pending_orders(self) -> List[orders.Order]:
+        r = await self._api_call('POST', '/rest/trading/v1/accounts/summary', json=[])
+        return [orders.Order.from_dict(o) for o in r.get('valueOrders', {}).get('items', [])]
+
+    async def pending_orders_for(self, ticker: str) -> List[orders.Order]:
+        # Concurrent callers share the summary fetched by the first one.
+        if self.client.pending.reconcile_due():
+            if self._reconciling is None or self._reconciling.done():
+                self._reconciling = asyncio.ensure_future(self._reconcile())
+            await asyncio.shield(self._reconciling)
+        return self.client.pending.get(ticker)
+
+    async def _reconcile(self):
+        self.client.pending.reconcile(await self.pending_orders())
+
+    async def execute_order(self, ticker: str, currency: str, amount: float,
+                            master_currency: str, currency_priority: Tuple[str, ...]) -> Optional[orders.Order]:
+        return await self._with_session_renewal(self._execute_order, ticker, currency, amount, master_currency, currency_priority)
+
+    async def _with_session_renewal(self, func: Callable[..., Awaitable[R]], *args, **kwargs) -> R:
+        headers = self.client.equity.headers
+        try:
+            return await func(*args, **kwargs)
+        except CookiesExpiredException:
+            logging.info('T212 cookies have expired, renewing and retrying')
+            try:
+                await asyncio.to_thread(self.client.sessions.renew, headers)
+            except Exception:
+                logging.exception('failed to renew T212 session')
+                raise CookiesExpiredException()
+            return await func(*args, **kwargs)
+
+    async def _execute_order(self, ticker: str, currency: str, amount: float,
+                             master_currency: str, currency_priority: Tuple[str, ...]) -> Optional[orders.Order]:
+        order = EquityOrder(
+            instrument_code=ticker,
+            order_type=OrderType.MARKET,
+            value=0,
+        )
+
+        wallets = self.client.wallets
+        if not wallets.fresh():
+            await asyncio.to_thread(self.client.refresh_wallets)
+        for currency in order_currencies(currency, currency_priority):
+            if not wallets.can_afford(currency, 0.01):  # skipping empty wallets before fetching FX rates
+                continue
+            fx_rate = await self.fx_rate(master_currency, currency)
+            order.currency = currency
+            order.value = round(amount * fx_rate, 2)
+            if not wallets.can_afford(currency, order.value):
+                logging.info('%s wallet can\'t afford %s %s for %s', currency, order.value, currency, ticker)
+                continue
+
+            r = await asyncio.to_thread(self.client.equity.execute_order, order)
+            if not check_order_response(r, ticker, currency):
+                wallets.exhaust(currency)
+                continue
+            wallets.spend(currency, order.value)
+
+            res = orders.Order(
+                ticker=ticker,
+                amount=order.value,
+                currency=currency,
+                created_at=now(),
+                fx_rate=fx_rate,
+            )
+            self.client.pending.add(res)
+            return res
+
+        raise InsufficientFundsException()
+
+    async def _api_call(self, method: str, path: str, **kwargs) -> Any:
+        return await self._with_session_renewal(self._request, method, path, **kwargs)
+
+    @retry(reraise=True, retry=retry_if_not_exception_type(CookiesExpiredException), stop=stop_after_attempt(5), wait=wait_exponential(max=30), before_sleep=transport.record_retry)
+    async def _request(self, method: str, path: str, **kwargs) -> Any:
+        async with self._http.session.request(method, f'{self.client.equity.base_url}{path}',
+                                              headers=self.client.equity.headers, **kwargs) as r:
+            if r.status == 401:
+                raise CookiesExpiredException()
+            r.raise_for_status()
+            data = await r.json()
+        if data.get('code'):
+            raise ValueError(data)
+        return data
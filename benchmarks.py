@@ -0,0 +1,373 @@
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Mapping, Optional
+
+from models import exchanges, instruments, pies
+from models.accounts import Plan
+from models.orders import OrderOutcome, ScheduledOrder
+from scheduler import *
+from utils import *
+
+__all__ = [
+    'benchmark',
+    'run_benchmarks',
+    'compare',
+]
+
+_benchmarks: Dict[str, Callable[[], Callable[[], object]]] = {}
+_db_benchmarks = set()
+
+
+def benchmark(name: str, db: bool = False):
+    # Registers a setup function returning the function to measure.
+    def register(setup: Callable[[], Callable[[], object]]):
+        _benchmarks[name] = setup
+        if db:
+            _db_benchmarks.add(name)
+        return setup
+
+    return register
+
+
+# Synthetic data.
+
+def working_schedule_dict(ws_id: int, weeks: int, since: Optional[datetime.datetime] = None) -> dict:
+    # Trading days with pre-market, regular and after hours sessions, starting a week ago.
+    day = (since or now() - datetime.timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+    events = []
+    for _ in range(weeks * 7):
+        if day.weekday() < 5:
+            for hours, event_type in [(4, 'PRE_MARKET_OPEN'), (9.5, 'OPEN'), (16, 'CLOSE'),
+                                      (16.01, 'AFTER_HOURS_OPEN'), (20, 'AFTER_HOURS_CLOSE')]:
+                events.append({'date': (day + datetime.timedelta(hours=hours)).isoformat(), 'type': event_type})
+        day += datetime.timedelta(days=1)
+    return {'id': ws_id, 'timeEvents': events}
+
+
+def exchanges_dump(count: int, schedules_per_exchange: int = 2, weeks: int = 3) -> List[dict]:
+    return [{
+        'id': ex_id,
+        'name': f'Exchange {ex_id}',
+        'workingSchedules': [working_schedule_dict(ex_id * schedules_per_exchange + i, weeks)
+                             for i in range(schedules_per_exchange)],
+    } for ex_id in range(count)]
+
+
+def instruments_dump(count: int, working_schedule_ids: List[int]) -> List[dict]:
+    rnd = random.Random(count)
+    return [{
+        'ticker': f'T{i}_US_EQ',
+        'type': 'STOCK',
+        'workingScheduleId': rnd.choice(working_schedule_ids),
+        'isin': f'US{i:010d}',
+        'currencyCode': rnd.choice(['USD', 'EUR', 'GBX']),
+        'name': f'Instrument {i} Inc.',
+        'shortName': f'T{i}',
+        'minTradeQuantity': 0.01,
+        'maxOpenQuantity': 10000.0,
+        'addedOn': '2020-01-01T00:00:00.000+00:00',
+    } for i in range(count)]
+
+
+def pie_dict(tickers: List[str]) -> dict:
+    share = 1 / len(tickers)
+    return {
+        'instruments': [{
+            'ticker': ticker,
+            'result': {'investedValue': 0.0, 'value': 0.0, 'result': 0.0, 'resultCoef': 0.0},
+            'expectedShare': share,
+            'currentShare': share,
+            'ownedQuantity': 0.0,
+        } for ticker in tickers],
+        'settings': {
+            'id': 1,
+            'name': 'benchmark',
+            'creationDate': '2020-01-01T00:00:00.000+00:00',
+            'dividendCashAction': 'REINVEST',
+        },
+    }
+
+
+class StaticApiClient:
+    def __init__(self, exchange_content: str, instrument_content: str):
+        self._schedules = exchanges.WorkingSchedules(exchange_content)
+        self._instrument_info = instruments.InstrumentIndex(instrument_content)
+
+    def get_working_schedules(self) -> Mapping[int, exchanges.ScheduleIndex]:
+        return self._schedules
+
+    def get_instrument_info(self) -> Mapping[str, instruments.Instrument]:
+        return self._instrument_info
+
+
+def pie_instruments(pie_size: int, exchange_count: int = 10, instrument_count: int = 1000) -> List[Instrument]:
+    exchange_dump = exchanges_dump(exchange_count)
+    ws_ids = [ws['id'] for e in exchange_dump for ws in e['workingSchedules']]
+    instrument_dump = instruments_dump(instrument_count, ws_ids)
+    pie = pies.Pie.from_dict(pie_dict([i['ticker'] for i in instrument_dump[:pie_size]]))
+    return collect_instruments(StaticApiClient(json.dumps(exchange_dump), json.dumps(instrument_dump)), pie)
+
+
+# Benchmarks.
+
+def week_orders(insts: List[Instrument], period: datetime.timedelta) -> List[ScheduledOrder]:
+    return extend_schedule(insts, {}, 1000, period, now() + datetime.timedelta(days=7), 'benchmark')[0]
+
+
+@benchmark('scheduler.extend_schedule[50 instruments, 1h, 24h ahead]')
+def extend_schedule_1h():
+    insts = pie_instruments(50)
+    return lambda: extend_schedule(insts, {}, 1000, datetime.timedelta(hours=1), now() + datetime.timedelta(hours=24), 'benchmark')
+
+
+@benchmark('scheduler.extend_schedule[50 instruments, 5min, 24h ahead]')
+def extend_schedule_5min():
+    insts = pie_instruments(50)
+    return lambda: extend_schedule(insts, {}, 1000, datetime.timedelta(minutes=5), now() + datetime.timedelta(hours=24), 'benchmark')
+
+
+@benchmark('scheduler.extend_schedule[50 instruments, 5min, next tick]')
+def extend_schedule_next_tick():
+    # A schedule check with the lookahead already filled, which is the usual case.
+    insts = pie_instruments(50)
+    until = now() + datetime.timedelta(hours=24)
+    _, entries = extend_schedule(insts, {}, 1000, datetime.timedelta(minutes=5), until, 'benchmark')
+    ledger = {e.ticker: e for e in entries}
+    return lambda: extend_schedule(insts, ledger, 1000, datetime.timedelta(minutes=5), until + datetime.timedelta(minutes=15), 'benchmark')
+
+
+@benchmark('scheduler.validate_orders[50 instruments, 1h]')
+def validate_orders_1h():
+    insts = pie_instruments(50)
+    orders = week_orders(insts, datetime.timedelta(hours=1))
+    return lambda: validate_orders(insts, orders)
+
+
+@benchmark('scheduler.validate_orders[50 instruments, 5min]')
+def validate_orders_5min():
+    insts = pie_instruments(50)
+    orders = week_orders(insts, datetime.timedelta(minutes=5))
+    return lambda: validate_orders(insts, orders)
+
+
+@benchmark('scheduler.collect_instruments[200 of 10000 instruments]')
+def collect_instruments_10000():
+    exchange_dump = exchanges_dump(20)
+    ws_ids = [ws['id'] for e in exchange_dump for ws in e['workingSchedules']]
+    instrument_dump = instruments_dump(10000, ws_ids)
+    pie = pies.Pie.from_dict(pie_dict([i['ticker'] for i in instrument_dump[:200]]))
+    exchange_content, instrument_content = json.dumps(exchange_dump), json.dumps(instrument_dump)
+
+    # Includes decoding the metadata, which is what a new snapshot costs.
+    return lambda: collect_instruments(StaticApiClient(exchange_content, instrument_content), pie)
+
+
+@benchmark('models.exchanges.Exchange.from_dict[20 exchanges, 3 weeks]')
+def exchange_from_dict():
+    dump = exchanges_dump(20)
+    return lambda: [exchanges.Exchange.from_dict(e) for e in dump]
+
+
+@benchmark('models.exchanges.WorkingSchedules[20 exchanges, 3 weeks]')
+def working_schedules():
+    content = json.dumps(exchanges_dump(20))
+    return lambda: exchanges.WorkingSchedules(content)
+
+
+@benchmark('models.instruments.Instrument.from_dict[10000 instruments]')
+def instrument_from_dict():
+    dump = instruments_dump(10000, list(range(40)))
+    return lambda: [instruments.Instrument.from_dict(i) for i in dump]
+
+
+@benchmark('models.instruments.InstrumentIndex[10000 instruments]')
+def instrument_index():
+    content = json.dumps(instruments_dump(10000, list(range(40))))
+    return lambda: instruments.InstrumentIndex(content)
+
+
+@benchmark('models.pies.Pie.from_dict[200 instruments]')
+def pie_from_dict():
+    d = pie_dict([f'T{i}_US_EQ' for i in range(200)])
+    return lambda: pies.Pie.from_dict(d)
+
+
+def db_plan() -> Plan:
+    return Plan(
+        account='benchmark',
+        pie='benchmark',
+        weekly_amount=1000,
+        investment_period=datetime.timedelta(minutes=5),
+        master_currency='EUR',
+        currency_priority=('EUR',),
+    )
+
+
+def db_orders():
+    return week_orders(pie_instruments(50), datetime.timedelta(minutes=5))
+
+
+@benchmark('db.put_scheduled_orders[50 instruments, 5min]', db=True)
+def db_put_scheduled_orders():
+    import db  # needs psycopg, so only imported when db benchmarks run
+    plan, orders = db_plan(), db_orders()
+
+    def run():
+        with db.connection() as conn, conn.transaction():
+            db.put_scheduled_orders(plan, *orders, conn=conn)
+            db.drop_scheduled_orders(plan, conn=conn)
+
+    return run
+
+
+@benchmark('db.scheduled_orders[50 instruments, 5min]', db=True)
+def db_scheduled_orders():
+    import db
+    plan = db_plan()
+    db.drop_scheduled_orders(plan)
+    db.put_scheduled_orders(plan, *db_orders())
+    return lambda: db.scheduled_orders(plan)
+
+
+@benchmark('db.scheduled_orders_to_execute[50 instruments, 5min]', db=True)
+def db_scheduled_orders_to_execute():
+    import db
+    plan = db_plan()
+    db.drop_scheduled_orders(plan)
+    db.put_scheduled_orders(plan, *db_orders())
+    return lambda: db.scheduled_orders_to_execute(plan)
+
+
+@benchmark('db.postpone_scheduled_order', db=True)
+def db_postpone_scheduled_order():
+    import db
+    plan = db_plan()
+    orders = db_orders()
+    db.drop_scheduled_orders(plan)
+
+    def run():
+        with db.connection() as conn, conn.transaction():
+            db.put_scheduled_orders(plan, orders[0], conn=conn)
+            db.postpone_scheduled_order(plan, orders[0], conn=conn)
+            db.drop_leftovers(plan, orders[0].ticker, conn=conn)
+
+    return run
+
+
+@benchmark('db.save_outcomes[50 postponed orders]', db=True)
+def db_save_outcomes():
+    import db
+    plan = db_plan()
+    orders = db_orders()[:50]
+    outcomes = [OrderOutcome(o, postponed=True) for o in orders]
+    db.drop_scheduled_orders(plan)
+
+    def run():
+        with db.connection() as conn, conn.transaction():
+            db.put_scheduled_orders(plan, *orders, conn=conn)
+            db.save_outcomes(plan, outcomes, conn=conn)
+            for ticker in {o.ticker for o in orders}:
+                db.drop_leftovers(plan, ticker, conn=conn)
+
+    return run
+
+
+def measure(func: Callable[[], object], min_time: float, repeat: int) -> dict:
+    # Calls per run are picked so that a run takes at least min_time.
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        if (elapsed := time.perf_counter() - started) >= min_time:
+            break
+        number *= 2
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+    }
+
+
+def run_benchmarks(pattern: str = '', with_db: bool = False, min_time: float = 0.2, repeat: int = 5) -> dict:
+    results = {}
+    for name, setup in _benchmarks.items():
+        if pattern not in name or (name in _db_benchmarks and not with_db):
+            continue
+        results[name] = measure(setup(), min_time, repeat)
+        print(f'{name:<70}{results[name]["median"] * 1000:>12.3f} ms', file=sys.stderr)
+    if with_db:
+        import db
+        db.drop_scheduled_orders(db_plan())
+    return {
+        'created_at': now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> List[str]:
+    # Returns names of benchmarks whose median got slower by more than threshold.
+    regressions = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        before, after = old['results'].get(name), new['results'].get(name)
+        if before is None or after is None:
+            print(f'{name:<70}{"only in " + ("new" if before is None else "old"):>30}')
+            continue
+        change = after['median'] / before['median'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<70}{before["median"] * 1000:>12.3f} ms{after["median"] * 1000:>12.3f} ms{change:>+9.1%}'
+              f'{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Autoinvest micro-benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run benchmarks and save results as JSON')
+    run_parser.add_argument('-o', '--output', default='benchmarks.json')
+    run_parser.add_argument('-k', '--pattern', default='', help='only run benchmarks with the pattern in their name')
+    run_parser.add_argument('--db', action='store_true', help='also run db benchmarks against the local Postgres')
+    run_parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per run')
+    run_parser.add_argument('--repeat', type=int, default=5)
+
+    compare_parser = commands.add_parser('compare', help='compare two results and flag regressions')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative slowdown')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        results = run_benchmarks(args.pattern, args.db, args.min_time, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if regressions := compare(old, new, args.threshold):
+            print(f'{len(regressions)} regressions', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
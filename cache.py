@@ -0,0 +1,166 @@
+import datetime
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, fields
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+from utils import now
+
+__all__ = [
+    'CacheStats',
+    'Cache',
+    'cache_stats',
+]
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+_registry: 'weakref.WeakSet[Cache]' = weakref.WeakSet()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    load_errors: int = 0
+    load_seconds_total: float = 0.0
+    load_seconds_max: float = 0.0
+    evictions: int = 0
+    size: int = 0
+
+    def merge(self, other: 'CacheStats') -> 'CacheStats':
+        return CacheStats(**{
+            f.name: max(getattr(self, f.name), getattr(other, f.name)) if f.name == 'load_seconds_max'
+            else getattr(self, f.name) + getattr(other, f.name)
+            for f in fields(self)
+        })
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total else 0.0
+
+
+@dataclass
+class _Entry:
+    value: Any
+    cached_at: datetime.datetime
+
+
+# TTL + LRU cache. Entries older than ttl are still served for stale_ttl while
+# being reloaded in the background. Concurrent loads of the same key are
+# deduplicated, callers wait for the load that is already in flight.
+class Cache(Generic[K, V]):
+    def __init__(self, name: str, ttl: Optional[datetime.timedelta] = None,
+                 stale_ttl: Optional[datetime.timedelta] = None, maxsize: Optional[int] = None):
+        self.name = name
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[K, _Entry] = OrderedDict()
+        self._loading: Dict[K, Future] = {}
+        self._stats = CacheStats()
+        _registry.add(self)
+
+    def get(self, key: K, loader: Callable[[], V]) -> V:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now() - entry.cached_at
+                if self._ttl is None or age <= self._ttl:
+                    self._entries.move_to_end(key)
+                    self._stats.hits += 1
+                    return entry.value
+                if self._stale_ttl is not None and age <= self._ttl + self._stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._stats.stale_hits += 1
+                    future, owner = self._start_load(key)
+                    if owner:
+                        threading.Thread(target=self._load, args=(key, loader, future), daemon=True,
+                                         name=f'cache-{self.name}').start()
+                    return entry.value
+            self._stats.misses += 1
+            future, owner = self._start_load(key)
+
+        if owner:
+            self._load(key, loader, future)
+        return future.result()
+
+    def get_fresh(self, key: K) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self._ttl is not None and now() - entry.cached_at > self._ttl):
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            return entry.value
+
+    def peek(self, key: K) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry is not None else None
+
+    def put(self, key: K, value: V):
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key: Optional[K] = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            self._stats.size = len(self._entries)
+            return CacheStats(**{f.name: getattr(self._stats, f.name) for f in fields(self._stats)})
+
+    def _start_load(self, key: K):
+        if (future := self._loading.get(key)) is not None:
+            return future, False
+        future = self._loading[key] = Future()
+        return future, True
+
+    def _load(self, key: K, loader: Callable[[], V], future: Future):
+        started = time.perf_counter()
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._stats.load_errors += 1
+                self._loading.pop(key, None)
+            logging.debug('failed to load %s cache entry %r', self.name, key)
+            future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats.loads += 1
+            self._stats.load_seconds_total += elapsed
+            self._stats.load_seconds_max = max(self._stats.load_seconds_max, elapsed)
+            self._store(key, value)
+            self._loading.pop(key, None)
+        future.set_result(value)
+
+    def _store(self, key: K, value: V):
+        self._entries[key] = _Entry(value, now())
+        self._entries.move_to_end(key)
+        while self._maxsize is not None and len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self._stats.evictions += 1
+
+
+def cache_stats() -> Dict[str, CacheStats]:
+    res = {}
+    for cache in list(_registry):
+        stats = cache.stats()
+        res[cache.name] = res[cache.name].merge(stats) if cache.name in res else stats
+    return res
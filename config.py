@@ -3,34 +3,44 @@ import datetime
 from dateutil.tz import gettz
 from pytrading212.constants import Mode
 
+from models.accounts import Account, Plan
+
 __all__ = [
     'MODE',
-    'EMAIL',
-    'PASSWORD',
-    'T212_TOKEN',
-    'PG_PASSWORD',
-    'TELEGRAM_USER',
-    'TELEGRAM_TOKEN',
     'AUTOINVEST_PIE',
     'MASTER_CURRENCY',
     'CURRENCY_PRIORITY',
     'WEEKLY_AMOUNT',
     'INVESTMENT_PERIOD',
+    'ACCOUNTS',
+    'PLANS',
     'TIMEZONE',
     'MAX_MESSAGES_PER_HOUR',
+    'NOTIFICATION_BATCH_WINDOW',
+    'FX_RATE_MAX_AGE',
+    'REJECTED_AMOUNT_MAX_AGE',
+    'PENDING_ORDER_GRACE',
+    'PENDING_ORDERS_RECONCILE_INTERVAL',
+    'SESSION_MAX_AGE',
+    'SESSION_CHECK_INTERVAL',
+    'ORDER_EXECUTION_CONCURRENCY',
+    'WALLETS_MAX_AGE',
+    'HTTP_CONNECT_TIMEOUT',
+    'HTTP_READ_TIMEOUT',
+    'HTTP_POOL_SIZE',
+    'SLOW_TICK',
+    'MIN_TICK_INTERVAL',
+    'MAX_TICK_INTERVAL',
+    'PIE_CHECK_INTERVAL',
+    'SCHEDULE_CHECK_INTERVAL',
+    'SCHEDULE_LOOKAHEAD',
+    'STATE_MIRROR',
+    'ASYNC_CLIENTS',
+    'GROUP_COMMIT',
+    'METRICS_PORT',
 ]
 
 MODE = Mode.LIVE
-if MODE is Mode.LIVE:
-    T212_TOKEN = open('.secrets/t212_live_token', 'r').read().strip()
-else:
-    T212_TOKEN = open('.secrets/t212_demo_token', 'r').read().strip()
-
-EMAIL = open('.secrets/t212_email', 'r').read().strip()
-PASSWORD = open('.secrets/t212_password', 'r').read().strip()
-PG_PASSWORD = open('.secrets/pg_password', 'r').read().strip()
-TELEGRAM_USER = int(open('.secrets/telegram_user', 'r').read().strip())
-TELEGRAM_TOKEN = open('.secrets/telegram_token', 'r').read().strip()
 
 AUTOINVEST_PIE = 'autoinvest'
 MASTER_CURRENCY = 'EUR'
@@ -38,5 +48,60 @@ CURRENCY_PRIORITY = ('EUR', 'USD')
 WEEKLY_AMOUNT = 1250  # in master currency
 INVESTMENT_PERIOD = datetime.timedelta(hours=1)
 
+# Every account has its own secrets folder with t212_email, t212_password and
+# t212_live_token/t212_demo_token, and can autoinvest into several pies. All
+# plans run in one process, each in its own worker.
+ACCOUNTS = [
+    Account(name='default', mode=MODE, secrets_dir='.secrets'),
+]
+PLANS = [
+    Plan(
+        account='default',
+        pie=AUTOINVEST_PIE,
+        weekly_amount=WEEKLY_AMOUNT,
+        investment_period=INVESTMENT_PERIOD,
+        master_currency=MASTER_CURRENCY,
+        currency_priority=CURRENCY_PRIORITY,
+    ),
+]
+
 TIMEZONE = gettz('Europe/Amsterdam')
 MAX_MESSAGES_PER_HOUR = 5
+NOTIFICATION_BATCH_WINDOW = datetime.timedelta(seconds=2)  # notifications queued within it are sent as one message
+FX_RATE_MAX_AGE = datetime.timedelta(minutes=15)  # how stale FX rates used for orders can be
+REJECTED_AMOUNT_MAX_AGE = datetime.timedelta(days=1)  # how long amounts rejected as too small are not retried
+PENDING_ORDER_GRACE = datetime.timedelta(minutes=5)  # placed orders count as pending after that until reconciled
+PENDING_ORDERS_RECONCILE_INTERVAL = datetime.timedelta(minutes=30)
+SESSION_MAX_AGE = datetime.timedelta(hours=6)  # T212 cookies are renewed in the background after that
+SESSION_CHECK_INTERVAL = datetime.timedelta(minutes=10)
+ORDER_EXECUTION_CONCURRENCY = 4  # tickers executed at the same time, keep below the DB pool size
+WALLETS_MAX_AGE = datetime.timedelta(minutes=10)  # how long free funds snapshot is used to pick order currency
+
+HTTP_CONNECT_TIMEOUT = 5  # seconds
+HTTP_READ_TIMEOUT = 30  # seconds
+HTTP_POOL_SIZE = 8  # keep-alive connections per host
+SLOW_TICK = datetime.timedelta(seconds=30)  # main loop ticks slower than that log HTTP stats
+
+# Main loop wakes up for the next scheduled order or at least every
+# MAX_TICK_INTERVAL. Pie composition and the schedule are checked in the
+# background on their own cadences.
+MIN_TICK_INTERVAL = datetime.timedelta(seconds=1)
+MAX_TICK_INTERVAL = datetime.timedelta(minutes=5)
+PIE_CHECK_INTERVAL = datetime.timedelta(minutes=1)
+SCHEDULE_CHECK_INTERVAL = datetime.timedelta(minutes=15)
+# Orders are generated this far ahead on every schedule check.
+SCHEDULE_LOOKAHEAD = datetime.timedelta(hours=24)
+
+# Keep scheduled orders, leftovers and state in memory, writing through to the DB.
+STATE_MIRROR = True
+
+# Overlap independent T212 requests in the main loop using asyncio clients.
+ASYNC_CLIENTS = False
+
+# Write postponed and skipped orders of a tick in one transaction at the end of
+# the tick instead of one transaction per order. Executed orders are always
+# written right away.
+GROUP_COMMIT = True
+
+# Prometheus metrics are served on localhost, None disables the endpoint.
+METRICS_PORT = 9412
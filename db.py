@@ -1,45 +1,79 @@
 import datetime
 import functools
-from typing import Tuple, List, ParamSpec, TypeVar, Callable, Optional, Any
+import threading
+from typing import Tuple, List, ParamSpec, TypeVar, Callable, Optional, Any, Dict
 
+import psycopg
 from psycopg import Connection
 from psycopg.rows import class_row
 from psycopg.types.json import Jsonb
 from psycopg_pool import ConnectionPool
 
 from config import *
-from models.orders import Order, ScheduledOrder
+from models.accounts import Plan
+from models.orders import LedgerEntry, Order, OrderOutcome, ScheduledOrder
 from utils import *
 
 __all__ = [
     'connection',
     'put_scheduled_orders',
     'drop_scheduled_orders',
-    'scheduled_order_count',
     'scheduled_orders_to_execute',
     'next_order_scheduled_for',
     'delete_scheduled_order',
+    'replace_scheduled_orders',
+    'ledger',
+    'put_ledger',
+    'replace_ledger',
     'leftovers',
     'add_leftovers',
     'drop_leftovers',
     'put_orders',
+    'save_executed_order',
+    'postpone_scheduled_order',
+    'save_outcomes',
+    'all_leftovers',
     'state',
     'update_state',
     'enabled',
     'enable',
     'disable',
+    'WAKE_UP_CHANNEL',
+    'wake_up',
+    'listen',
+    'pool_stats',
 ]
 
+WAKE_UP_CHANNEL = 'autoinvest_wake_up'
+
 _settings = {
     'user': 'autoinvest',
-    'password': PG_PASSWORD,
     'dbname': 'autoinvest',
     'host': '127.0.0.1',
     'port': '5432',
 }
-_pool = ConnectionPool(' '.join(f'{k}={v}' for k, v in _settings.items()), min_size=1, max_size=8, max_idle=4)
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def _conninfo() -> str:
+    return ' '.join(f'{k}={v}' for k, v in {**_settings, 'password': read_secret('pg_password')}.items())
+
+
+def _get_pool() -> ConnectionPool:
+    # Opened on first use, so that importing the module doesn't connect.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Statements are prepared server-side on their first execution on a
+            # connection, later executions only send the parameters.
+            _pool = ConnectionPool(_conninfo(), min_size=1, max_size=8, max_idle=4, kwargs={'prepare_threshold': 0})
+        return _pool
+
+
+def connection(timeout: Optional[float] = None):
+    return _get_pool().connection(timeout)
 
-connection = _pool.connection
 
 P = ParamSpec('P')
 R = TypeVar('R')
@@ -57,103 +91,205 @@ def with_conn(func: Callable[P, R]) -> Callable[P, R]:
     return wrapper
 
 
-@with_conn
-def put_scheduled_orders(*orders: ScheduledOrder, conn: Connection = None):
-    conn.cursor().executemany(
-        '''insert into scheduled_orders (ticker, currency, amount, execute_at)
-        values (%s, %s, %s, %s)''',
-        [(o.ticker, o.currency, o.amount, o.execute_at) for o in orders],
-    )
+_SCHEDULED_ORDER_COLUMNS = 'ticker, amount, currency, execute_at'
 
 
 @with_conn
-def drop_scheduled_orders(conn: Connection = None):
-    conn.execute('delete from scheduled_orders')
+def put_scheduled_orders(plan: Plan, *orders: ScheduledOrder, conn: Connection = None):
+    conn.cursor().executemany(
+        '''insert into scheduled_orders (account, pie, ticker, currency, amount, execute_at)
+        values (%s, %s, %s, %s, %s, %s)''',
+        [(plan.account, plan.pie, o.ticker, o.currency, o.amount, o.execute_at) for o in orders],
+    )
 
 
 @with_conn
-def drop_expired_scheduled_orders(conn: Connection = None):
-    conn.execute('delete from scheduled_orders where execute_at < %s', (now() - INVESTMENT_PERIOD,))
+def drop_scheduled_orders(plan: Plan, conn: Connection = None):
+    conn.execute('delete from scheduled_orders where account = %s and pie = %s', (plan.account, plan.pie))
+    conn.execute('delete from schedule_ledger where account = %s and pie = %s', (plan.account, plan.pie))
 
 
 @with_conn
-def scheduled_order_count(conn: Connection = None) -> int:
-    return conn. \
-        execute('select count(1) from scheduled_orders'). \
-        fetchone()[0]
+def drop_expired_scheduled_orders(plan: Plan, before: Optional[datetime.datetime] = None, conn: Connection = None):
+    conn.execute(
+        'delete from scheduled_orders where account = %s and pie = %s and execute_at < %s',
+        (plan.account, plan.pie, before or now() - plan.investment_period),
+    )
 
 
 @with_conn
-def scheduled_orders(conn: Connection = None) -> List[ScheduledOrder]:
+def scheduled_orders(plan: Plan, conn: Connection = None) -> List[ScheduledOrder]:
     return conn. \
         cursor(row_factory=class_row(ScheduledOrder)). \
-        execute('select * from scheduled_orders'). \
+        execute(f'select {_SCHEDULED_ORDER_COLUMNS} from scheduled_orders where account = %s and pie = %s',
+                (plan.account, plan.pie)). \
         fetchall()
 
 
 @with_conn
-def scheduled_orders_to_execute(conn: Connection = None) -> List[ScheduledOrder]:
+def scheduled_orders_to_execute(plan: Plan, conn: Connection = None) -> List[ScheduledOrder]:
     return conn. \
         cursor(row_factory=class_row(ScheduledOrder)). \
-        execute('select * from scheduled_orders where execute_at <= %s', (now(),)). \
+        execute(f'select {_SCHEDULED_ORDER_COLUMNS} from scheduled_orders where account = %s and pie = %s and execute_at <= %s',
+                (plan.account, plan.pie, now())). \
         fetchall()
 
 
 @with_conn
-def next_order_scheduled_for(conn: Connection = None) -> Optional[datetime.datetime]:
+def next_order_scheduled_for(plan: Optional[Plan] = None, conn: Connection = None) -> Optional[datetime.datetime]:
+    if plan is None:
+        return conn. \
+            execute('select min(so.execute_at) from scheduled_orders as so'). \
+            fetchone()[0]
     return conn. \
-        execute('select min(so.execute_at) from scheduled_orders as so'). \
+        execute('select min(so.execute_at) from scheduled_orders as so where so.account = %s and so.pie = %s',
+                (plan.account, plan.pie)). \
         fetchone()[0]
 
 
 @with_conn
-def delete_scheduled_order(order: ScheduledOrder, conn: Connection = None):
+def delete_scheduled_order(plan: Plan, order: ScheduledOrder, conn: Connection = None):
     conn.execute(
-        'delete from scheduled_orders where ticker = %s and execute_at = %s',
-        (order.ticker, order.execute_at),
+        'delete from scheduled_orders where account = %s and pie = %s and ticker = %s and execute_at = %s',
+        (plan.account, plan.pie, order.ticker, order.execute_at),
     )
 
 
 @with_conn
-def leftovers(ticker: str, conn: Connection = None) -> float:
-    row = conn.execute('select amount from leftovers where ticker = %s', (ticker,)).fetchone()
+def replace_scheduled_orders(plan: Plan, deleted: List[ScheduledOrder], added: List[ScheduledOrder], conn: Connection = None):
+    conn.cursor().executemany(
+        'delete from scheduled_orders where account = %s and pie = %s and ticker = %s and execute_at = %s',
+        [(plan.account, plan.pie, o.ticker, o.execute_at) for o in deleted],
+    )
+    put_scheduled_orders(plan, *added, conn=conn)
+
+
+@with_conn
+def ledger(plan: Plan, conn: Connection = None) -> Dict[str, LedgerEntry]:
+    entries = conn. \
+        cursor(row_factory=class_row(LedgerEntry)). \
+        execute('select ticker, week_start, amount, scheduled_until from schedule_ledger where account = %s and pie = %s',
+                (plan.account, plan.pie)). \
+        fetchall()
+    return {e.ticker: e for e in entries}
+
+
+@with_conn
+def put_ledger(plan: Plan, *entries: LedgerEntry, conn: Connection = None):
+    conn.cursor().executemany(
+        '''insert into schedule_ledger (account, pie, ticker, week_start, amount, scheduled_until)
+        values (%s, %s, %s, %s, %s, %s)
+        on conflict (account, pie, ticker) do update
+        set week_start = excluded.week_start, amount = excluded.amount, scheduled_until = excluded.scheduled_until''',
+        [(plan.account, plan.pie, e.ticker, e.week_start, e.amount, e.scheduled_until) for e in entries],
+    )
+
+
+@with_conn
+def replace_ledger(plan: Plan, entries: List[LedgerEntry], conn: Connection = None):
+    conn.execute('delete from schedule_ledger where account = %s and pie = %s', (plan.account, plan.pie))
+    put_ledger(plan, *entries, conn=conn)
+
+
+@with_conn
+def leftovers(plan: Plan, ticker: str, conn: Connection = None) -> float:
+    row = conn.execute(
+        'select amount from leftovers where account = %s and pie = %s and ticker = %s',
+        (plan.account, plan.pie, ticker),
+    ).fetchone()
     return (row or [0.0])[0]
 
 
 @with_conn
-def add_leftovers(ticker: str, leftover_amount: float, conn: Connection = None):
+def all_leftovers(plan: Plan, conn: Connection = None) -> Dict[str, float]:
+    return dict(conn.execute(
+        'select ticker, amount from leftovers where account = %s and pie = %s',
+        (plan.account, plan.pie),
+    ).fetchall())
+
+
+@with_conn
+def add_leftovers(plan: Plan, ticker: str, leftover_amount: float, conn: Connection = None):
     if not leftover_amount:
         return
     conn.execute(
-        '''insert into leftovers as t (ticker, amount) values (%s, %s)
-        on conflict (ticker) do update set amount = t.amount + %s''',
-        (ticker, leftover_amount, leftover_amount),
+        '''insert into leftovers as t (account, pie, ticker, amount) values (%s, %s, %s, %s)
+        on conflict (account, pie, ticker) do update set amount = t.amount + %s''',
+        (plan.account, plan.pie, ticker, leftover_amount, leftover_amount),
     )
 
 
 @with_conn
-def drop_leftovers(ticker: str, conn: Connection = None):
-    conn.execute('delete from leftovers where ticker = %s', (ticker,))
+def drop_leftovers(plan: Plan, ticker: str, conn: Connection = None):
+    conn.execute(
+        'delete from leftovers where account = %s and pie = %s and ticker = %s',
+        (plan.account, plan.pie, ticker),
+    )
 
 
 @with_conn
-def put_orders(*orders: Order, conn: Connection = None):
+def put_orders(plan: Plan, *orders: Order, conn: Connection = None):
     conn.cursor().executemany(
-        'insert into orders (ticker, amount, currency, created_at) values (%s, %s, %s, %s)',
-        [(o.ticker, o.amount, o.currency, o.created_at) for o in orders],
+        '''insert into orders (account, pie, ticker, amount, currency, created_at, fx_rate)
+        values (%s, %s, %s, %s, %s, %s, %s)''',
+        [(plan.account, plan.pie, o.ticker, o.amount, o.currency, o.created_at, o.fx_rate) for o in orders],
     )
 
 
+# Statements of a write are sent in one pipeline, so they take a single round
+# trip together with the commit.
+
 @with_conn
-def state(conn: Connection = None) -> List[Tuple[str, str]]:
-    return conn.execute('select * from state order by key').fetchall()
+def save_executed_order(plan: Plan, order: Order, scheduled_order: ScheduledOrder, conn: Connection = None):
+    with conn.pipeline():
+        _save_executed_order(plan, order, scheduled_order, conn)
 
 
 @with_conn
-def update_state(state: List[Tuple[str, str]], conn: Connection = None):
-    conn.execute('delete from state')
-    conn.cursor().executemany('insert into state (key, value) values (%s, %s)', state)
-    drop_scheduled_orders(conn=conn)
+def postpone_scheduled_order(plan: Plan, order: ScheduledOrder, conn: Connection = None):
+    with conn.pipeline():
+        _postpone_scheduled_order(plan, order, conn)
+
+
+@with_conn
+def save_outcomes(plan: Plan, outcomes: List[OrderOutcome], conn: Connection = None):
+    # Outcomes of an execution batch in order, committed together.
+    with conn.pipeline():
+        for outcome in outcomes:
+            if outcome.order is not None:
+                _save_executed_order(plan, outcome.order, outcome.scheduled_order, conn)
+            elif outcome.postponed:
+                _postpone_scheduled_order(plan, outcome.scheduled_order, conn)
+            else:
+                delete_scheduled_order(plan, outcome.scheduled_order, conn=conn)
+
+
+def _save_executed_order(plan: Plan, order: Order, scheduled_order: ScheduledOrder, conn: Connection):
+    put_orders(plan, order, conn=conn)
+    delete_scheduled_order(plan, scheduled_order, conn=conn)
+    drop_leftovers(plan, scheduled_order.ticker, conn=conn)
+
+
+def _postpone_scheduled_order(plan: Plan, order: ScheduledOrder, conn: Connection):
+    add_leftovers(plan, order.ticker, order.amount, conn=conn)
+    delete_scheduled_order(plan, order, conn=conn)
+
+
+@with_conn
+def state(plan: Plan, conn: Connection = None) -> List[Tuple[str, str]]:
+    return conn.execute(
+        'select key, value from state where account = %s and pie = %s order by key',
+        (plan.account, plan.pie),
+    ).fetchall()
+
+
+@with_conn
+def update_state(plan: Plan, state: List[Tuple[str, str]], conn: Connection = None):
+    conn.execute('delete from state where account = %s and pie = %s', (plan.account, plan.pie))
+    conn.cursor().executemany(
+        'insert into state (account, pie, key, value) values (%s, %s, %s, %s)',
+        [(plan.account, plan.pie, k, v) for k, v in state],
+    )
 
 
 @with_conn
@@ -164,26 +300,41 @@ def enabled(conn: Connection = None) -> bool:
 @with_conn
 def enable(conn: Connection = None):
     _metadata_set('enabled', True, conn)
+    wake_up(conn=conn)
 
 
 @with_conn
 def disable(conn: Connection = None):
     _metadata_set('enabled', False, conn)
+    wake_up(conn=conn)
 
 
 @with_conn
-def can_send_message(text: str, conn: Connection = None) -> bool:
-    rows = conn. \
-        execute('select text from messages where sent_at > %s', (now() - datetime.timedelta(hours=1),)). \
-        fetchall()
-    sent_messages = [row[0] for row in rows]
-    return len(sent_messages) < MAX_MESSAGES_PER_HOUR and text not in sent_messages
+def wake_up(conn: Connection = None):
+    conn.execute(f'notify {WAKE_UP_CHANNEL}')
+
+
+def listen(channel: str, callback: Callable[[], None]):
+    # Blocks forever, calling back on every notification on the channel.
+    with psycopg.connect(_conninfo(), autocommit=True) as conn:
+        conn.execute(f'listen {channel}')
+        for _ in conn.notifies():
+            callback()
+
+
+def pool_stats() -> Dict[str, int]:
+    return _get_pool().get_stats()
+
+
+@with_conn
+def sent_messages(since: datetime.datetime, conn: Connection = None) -> List[Tuple[str, datetime.datetime]]:
+    return conn.execute('select text, sent_at from messages where sent_at > %s', (since,)).fetchall()
 
 
 @with_conn
-def record_message(text: str, conn: Connection = None):
-    conn.execute('insert into messages (text, sent_at) values (%s, %s)', (text, now()))
-    conn.execute('delete from messages where sent_at < %s', (now() - datetime.timedelta(hours=1),))
+def record_messages(texts: List[str], sent_at: datetime.datetime, conn: Connection = None):
+    conn.cursor().executemany('insert into messages (text, sent_at) values (%s, %s)', [(text, sent_at) for text in texts])
+    conn.execute('delete from messages where sent_at < %s', (sent_at - datetime.timedelta(hours=1),))
 
 
 def _metadata_get(key: str, conn: Connection) -> Any:
@@ -40,6 +40,9 @@ sudo -u postgres psql -c "CREATE USER autoinvest WITH ENCRYPTED PASSWORD '$(cat
 sudo -u postgres psql -c "CREATE DATABASE autoinvest;"
 sudo -u postgres psql -c "GRANT ALL PRIVILEGES ON DATABASE autoinvest to autoinvest;"
 sudo -u postgres psql -f ../schema/001_create_tables.sql
+sudo -u postgres psql -f ../schema/002_orders_fx_rate.sql
+sudo -u postgres psql -f ../schema/003_accounts_and_pies.sql
+sudo -u postgres psql -f ../schema/004_schedule_ledger.sql
 sudo -u postgres psql -d autoinvest -c "GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO autoinvest;"
 
 # Selenium
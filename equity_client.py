@@ -1,10 +1,12 @@
+import datetime
 import json
 import logging
+import os
 import shutil
+import threading
 import time
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Iterable, Tuple, Callable, TypeVar
 
-import requests
 from pytrading212 import Equity, EquityOrder
 from pytrading212 import OrderType
 from pytrading212 import constants
@@ -15,17 +17,26 @@ from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.wait import WebDriverWait
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_not_exception_type
 
+import transport
+from cache import Cache
 from config import *
 from models import orders
+from models.accounts import Account
+from pending_orders import PendingOrderTracker
 from utils import *
+from wallets import Wallets, parse_funds
 
 __all__ = [
     'SmolOrderException',
     'CookiesExpiredException',
     'InsufficientFundsException',
     'EquityClient',
+    'check_order_response',
+    'order_currencies',
 ]
 
+R = TypeVar('R')
+
 
 class SmolOrderException(Exception):
     pass
@@ -43,25 +54,34 @@ class EquityPatched(Equity):
     USER_AGENT = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
                   'AppleWebKit/537.36 (KHTML, like Gecko) '
                   'Chrome/116.0.0.0 Safari/537.36')
-    T212_COOKIES_FILENAME = '.secrets/t212_cookies'
-    USER_DATA_DIR = '.secrets/browser_data'
-
-    @retry(reraise=True, stop=stop_after_attempt(3), wait=wait_exponential(max=15))
-    def __init__(self):
-        self.session = f'TRADING212_SESSION_{MODE.name}'
-        self.base_url = f'https://{MODE.name.lower()}.trading212.com'
+    T212_COOKIES_FILENAME = 't212_cookies'
+    USER_DATA_DIR = 'browser_data'
+
+    def __init__(self, account: Account):
+        self.account = account
+        self.session = f'TRADING212_SESSION_{account.mode.name}'
+        self.base_url = account.base_url
+        self.cookies_filename = os.path.join(account.secrets_dir, self.T212_COOKIES_FILENAME)
+        self.user_data_dir = os.path.join(account.secrets_dir, self.USER_DATA_DIR)
+        self.cookies_updated_at: Optional[datetime.datetime] = None
+        self._http = transport.new_session()
 
         # Checking if current cookies are still working.
         self._load_cookies()
-        if self._cookies_valid():
+        if self.cookies_valid():
             logging.info('using cached T212 cookies')
             return
 
+        # Retried on its own, a failing login makes at most 3 attempts.
+        self.renew()
+
+    @retry(reraise=True, stop=stop_after_attempt(3), wait=wait_exponential(max=15))
+    def renew(self):
         self.driver = self._build_driver()
         try:
             # Checking if still logged in.
             self._refresh_cookies()
-            if self._cookies_valid():
+            if self.cookies_valid():
                 logging.info('still logged in, using refreshed T212 cookies')
                 self._dump_cookies()
                 return
@@ -77,13 +97,24 @@ class EquityPatched(Equity):
     def switch_to(self, trading: constants.Trading):
         super().switch_to(trading)
 
+    # Same requests as pytrading212 makes, but through the shared pool and with timeouts.
+    def execute_order(self, order: EquityOrder):
+        if hasattr(order, 'value'):
+            url = f'{self.base_url}/rest/v1/equity/value-order'
+        else:
+            url = f'{self.base_url}/rest/public/v2/equity/order'
+        return self._http.post(url, headers=self.headers, data=order.to_json()).json()
+
+    def get_funds(self):
+        return self._http.get(f'{self.base_url}/rest/v2/customer/accounts/funds', headers=self.headers).json()
+
     def _build_driver(self) -> webdriver.Chrome:
         options = webdriver.ChromeOptions()
         options.add_argument('--headless=new')
         options.add_argument('--start-maximized')
         options.add_argument('--window-size=1280,783')
         options.add_argument('--enable-file-cookies')
-        options.add_argument(f'--user-data-dir={self.USER_DATA_DIR}')
+        options.add_argument(f'--user-data-dir={self.user_data_dir}')
         options.add_argument('--disable-gpu')
         options.add_argument('--disable-dev-shm-usage')
         options.add_argument('--disable-extensions')
@@ -103,7 +134,7 @@ class EquityPatched(Equity):
             return webdriver.Chrome(options=options)
         except WebDriverException:
             try:
-                shutil.rmtree(self.USER_DATA_DIR)
+                shutil.rmtree(self.user_data_dir)
             except FileNotFoundError:
                 pass
             raise
@@ -130,8 +161,8 @@ class EquityPatched(Equity):
 
         # Authenticate
         WebDriverWait(self.driver, 5).until(expected_conditions.visibility_of_element_located((By.NAME, 'email')))
-        self.driver.find_element(By.NAME, 'email').send_keys(EMAIL)
-        self.driver.find_element(By.NAME, 'password').send_keys(PASSWORD)
+        self.driver.find_element(By.NAME, 'email').send_keys(self.account.email)
+        self.driver.find_element(By.NAME, 'password').send_keys(self.account.password)
 
         # Click login button
         self.driver.find_element(By.CLASS_NAME, constants.CLASS_LOGIN_BUTTON).click()
@@ -140,7 +171,7 @@ class EquityPatched(Equity):
         self._wait_trading_page_load('.account-menu-info')
 
         # Redirect to correct mode, DEMO or LIVE
-        if MODE.name not in self.driver.current_url:
+        if self.account.mode.name not in self.driver.current_url:
             self.driver.get(self.base_url)
             self._wait_trading_page_load('.account-menu-info')
 
@@ -164,17 +195,19 @@ class EquityPatched(Equity):
         }
 
     def _dump_cookies(self):
-        with open(self.T212_COOKIES_FILENAME, 'w') as f:
+        with open(self.cookies_filename, 'w') as f:
             json.dump(self.headers, f)
+        self.cookies_updated_at = now()
 
     def _load_cookies(self):
         try:
-            with open(self.T212_COOKIES_FILENAME, 'r') as f:
+            with open(self.cookies_filename, 'r') as f:
                 self.headers = json.load(f)
+            self.cookies_updated_at = datetime.datetime.fromtimestamp(os.path.getmtime(self.cookies_filename), tz=TIMEZONE)
         except Exception:
             pass
 
-    def _cookies_valid(self) -> bool:
+    def cookies_valid(self) -> bool:
         try:
             r = self.get_funds()
         except Exception:
@@ -190,63 +223,185 @@ class EquityPatched(Equity):
         time.sleep(5)
 
 
+# Renews T212 cookies in the background before they expire, and on demand
+# when a request fails because they have. New headers are passed to on_renew.
+class SessionManager:
+    def __init__(self, equity: EquityPatched, on_renew: Callable[[dict], None]):
+        self._equity = equity
+        self._on_renew = on_renew
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='t212-session', daemon=True)
+            self._thread.start()
+
+    def renew(self, expired: Optional[dict] = None):
+        with self._lock:
+            if expired is not None and self._equity.headers is not expired:
+                return  # already renewed by someone else
+            logging.info('renewing T212 session')
+            self._equity.renew()
+            self._on_renew(self._equity.headers)
+
+    def _watch(self):
+        while True:
+            time.sleep(SESSION_CHECK_INTERVAL.total_seconds())
+            headers = self._equity.headers
+            try:
+                updated_at = self._equity.cookies_updated_at
+                if updated_at is None or now() - updated_at > SESSION_MAX_AGE:
+                    logging.info('T212 cookies are older than %s', SESSION_MAX_AGE)
+                elif self._equity.cookies_valid():
+                    continue
+                self.renew(expired=headers)
+            except Exception:
+                logging.exception('failed to renew T212 session in the background')
+
+
+def order_currencies(currency: str, priority: Tuple[str, ...]) -> List[str]:
+    return list(dict.fromkeys((currency,) + tuple(priority)))
+
+
+# Returns False if the order failed because of insufficient funds in the wallet.
+def check_order_response(r: dict, ticker: str, currency: str) -> bool:
+    if not r.get('code'):
+        return True
+    if r['code'] == 'BusinessException' and r.get('context', {}).get('type') in ['AccountWalletNotFound', 'InsufficientFreeForStocksBuyValue']:
+        logging.info('insufficient funds of %s when buying %s', currency, ticker)
+        return False
+    if r['code'] == 'BusinessException' and r.get('context', {}).get('type') == 'MinValueExceeded':
+        raise SmolOrderException(r.get('message'))
+    if r['code'] == 'AuthenticationFailed':
+        raise CookiesExpiredException()
+    raise RuntimeError(f'unknown error while executing order: {r}')
+
+
 class EquityClient:
-    def __init__(self):
-        self._equity = EquityPatched()
-        self._session = requests.session()
+    FX_REFERENCE_AMOUNT = 10000  # large enough for the rounded conversion value to be precise
+
+    def __init__(self, account: Account):
+        self.account = account
+        self._equity = EquityPatched(account)
+        self._session = transport.new_session()
         self._session.headers.update(self._equity.headers)
+        self.sessions = SessionManager(self._equity, self._session.headers.update)
+        self.sessions.start()
+        self.fx_rates: Cache[Tuple[str, str], float] = Cache(f'EquityClient.fx_rates.{account.name}', ttl=FX_RATE_MAX_AGE)
+        self.pending = PendingOrderTracker()
+        self.wallets = Wallets()
 
-    def convert(self, currency_from: str, currency_to: str, amount: float) -> float:
+    @property
+    def equity(self) -> EquityPatched:
+        return self._equity
+
+    def fx_rate(self, currency_from: str, currency_to: str) -> float:
         if currency_from == currency_to:
-            return amount
-        r = self._api_call(
-            'POST', '/rest/trading/v1/fx-rates/conversion',
-            json={
-                'fromCurrency': currency_from,
-                'toCurrency': currency_to,
-                'amount': amount,
-            },
+            return 1.0
+        return self.fx_rates.get(
+            (currency_from, currency_to),
+            lambda: self._fetch_fx_rate(currency_from, currency_to),
         )
-        return r['value']
+
+    def convert(self, currency_from: str, currency_to: str, amount: float) -> float:
+        return amount * self.fx_rate(currency_from, currency_to)
+
+    def convert_many(self, conversions: Iterable[Tuple[str, str, float]]) -> List[float]:
+        conversions = list(conversions)
+        rates = {pair: self.fx_rate(*pair) for pair in {(c_from, c_to) for c_from, c_to, _ in conversions}}
+        return [amount * rates[(c_from, c_to)] for c_from, c_to, amount in conversions]
 
     def pending_orders(self) -> List[orders.Order]:
         r = self._api_call('POST', '/rest/trading/v1/accounts/summary', json=[])
         return [orders.Order.from_dict(o) for o in r.get('valueOrders', {}).get('items', [])]
 
-    def execute_order(self, ticker: str, currency: str, amount: float) -> Optional[orders.Order]:
+    def pending_orders_for(self, ticker: str) -> List[orders.Order]:
+        self.pending.reconcile_if_due(self.pending_orders)
+        return self.pending.get(ticker)
+
+    # The amount is in the master currency, wallets are tried in the priority order after the instrument currency.
+    def execute_order(self, ticker: str, currency: str, amount: float,
+                      master_currency: str, currency_priority: Tuple[str, ...]) -> Optional[orders.Order]:
+        return self.with_session_renewal(self._execute_order, ticker, currency, amount, master_currency, currency_priority)
+
+    def with_session_renewal(self, func: Callable[..., R], *args, **kwargs) -> R:
+        headers = self._equity.headers
+        try:
+            return func(*args, **kwargs)
+        except CookiesExpiredException:
+            logging.info('T212 cookies have expired, renewing and retrying')
+            try:
+                self.sessions.renew(expired=headers)
+            except Exception:
+                logging.exception('failed to renew T212 session')
+                raise CookiesExpiredException()
+            return func(*args, **kwargs)
+
+    def refresh_wallets(self):
+        if self.wallets.fresh():
+            return
+        try:
+            free = parse_funds(self._equity.get_funds())
+        except Exception:
+            logging.exception('failed to fetch free funds')
+            return
+        if free is not None:
+            self.wallets.update(free)
+
+    def _execute_order(self, ticker: str, currency: str, amount: float,
+                       master_currency: str, currency_priority: Tuple[str, ...]) -> Optional[orders.Order]:
         order = EquityOrder(
             instrument_code=ticker,
             order_type=OrderType.MARKET,
             value=0,
         )
 
-        currencies = (currency,) + CURRENCY_PRIORITY
-        for currency in currencies:
+        self.refresh_wallets()
+        for currency in order_currencies(currency, currency_priority):
+            if not self.wallets.can_afford(currency, 0.01):  # skipping empty wallets before fetching FX rates
+                continue
+            fx_rate = self.fx_rate(master_currency, currency)
             order.currency = currency
-            order.value = round(self.convert(MASTER_CURRENCY, currency, amount), 2)
+            order.value = round(amount * fx_rate, 2)
+            if not self.wallets.can_afford(currency, order.value):
+                logging.info('%s wallet can\'t afford %s %s for %s', currency, order.value, currency, ticker)
+                continue
 
             r = self._equity.execute_order(order)
-            if r.get('code'):
-                if r['code'] == 'BusinessException' and r.get('context', {}).get('type') in ['AccountWalletNotFound', 'InsufficientFreeForStocksBuyValue']:
-                    logging.info('insufficient funds of %s when buying %s', currency, ticker)
-                    continue
-                if r['code'] == 'BusinessException' and r.get('context', {}).get('type') == 'MinValueExceeded':
-                    raise SmolOrderException(r.get('message'))
-                if r['code'] == 'AuthenticationFailed':
-                    raise CookiesExpiredException()
-                raise RuntimeError(f'unknown error while executing order: {r}')
+            if not check_order_response(r, ticker, currency):
+                self.wallets.exhaust(currency)
+                continue
+            self.wallets.spend(currency, order.value)
 
-            return orders.Order(
+            res = orders.Order(
                 ticker=ticker,
                 amount=order.value,
                 currency=currency,
                 created_at=now(),
+                fx_rate=fx_rate,
             )
+            self.pending.add(res)
+            return res
 
         raise InsufficientFundsException()
 
-    @retry(reraise=True, retry=retry_if_not_exception_type(CookiesExpiredException), stop=stop_after_attempt(5), wait=wait_exponential(max=30))
+    def _fetch_fx_rate(self, currency_from: str, currency_to: str) -> float:
+        r = self._api_call(
+            'POST', '/rest/trading/v1/fx-rates/conversion',
+            json={
+                'fromCurrency': currency_from,
+                'toCurrency': currency_to,
+                'amount': self.FX_REFERENCE_AMOUNT,
+            },
+        )
+        return r['value'] / self.FX_REFERENCE_AMOUNT
+
     def _api_call(self, method: str, path: str, **kwargs) -> Any:
+        return self.with_session_renewal(self._request, method, path, **kwargs)
+
+    @retry(reraise=True, retry=retry_if_not_exception_type(CookiesExpiredException), stop=stop_after_attempt(5), wait=wait_exponential(max=30), before_sleep=transport.record_retry)
+    def _request(self, method: str, path: str, **kwargs) -> Any:
         r = self._session.request(method, f'{self._equity.base_url}{path}', **kwargs)
         if r.status_code == 401:
             raise CookiesExpiredException()
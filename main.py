@@ -1,113 +1,106 @@
-import collections
+import asyncio
 import logging
-import time
-import traceback
-
-from telebot.formatting import hpre
+import threading
+from typing import Callable, List
 
 import db
+import metrics
 from api_client import T212ApiClient
+from async_clients import *
 from config import *
 from equity_client import *
-from scheduler import *
+from metadata_store import MetadataStore
 from telegram import send_message
 from utils import *
-
-
-def run(equity: EquityClient, api_client: T212ApiClient):
-    # Checking if current state has changed.
-    pie = api_client.find_pie(AUTOINVEST_PIE)
-    if not pie:
-        logging.warning('"%s" pie is not found', AUTOINVEST_PIE)
-        return
-    pie_composition = sorted([(inst.ticker, inst.expected_share) for inst in pie.instruments])
-    if (state := build_state(pie_composition)) != db.state():
-        logging.info('state has changed, updating')
-        db.update_state(state)
-
-    # Validate scheduled order in case market open times have changed.
-    db.drop_expired_scheduled_orders()
-    pie_instruments = collect_instruments(api_client, pie)
-    if not validate_orders(pie_instruments):
-        logging.info('some orders scheduled when market is closed, invalidating')
-        db.drop_scheduled_orders()
-
-    # Scheduling new orders.
-    if not db.scheduled_order_count():
-        logging.info('scheduling new orders')
-        scheduled_orders = schedule_orders(pie_instruments, WEEKLY_AMOUNT, INVESTMENT_PERIOD)
-        db.put_scheduled_orders(*scheduled_orders)
-
-    # Executing orders.
-    pending_orders = None
-    for o in db.scheduled_orders_to_execute():
-        def postpone():
-            with db.connection() as conn, conn.transaction():
-                db.add_leftovers(o.ticker, o.amount, conn=conn)
-                db.delete_scheduled_order(o, conn=conn)
-
-        amount = round(o.amount + db.leftovers(o.ticker), 2)
-        logging.info('executing order for %s: %s %s', o.ticker, amount, MASTER_CURRENCY)
-
-        if pending_orders is None:
-            pending_orders = collections.defaultdict(list)
-            for po in equity.pending_orders():
-                pending_orders[po.ticker].append(po)
-        if o.ticker in pending_orders:
-            logging.error('%s still has some pending orders: %s', o.ticker, pending_orders[o.ticker])
-            send_message(f'{o.ticker} still has some pending orders created at ' +
-                         hpre(', '.join(po.created_at.astimezone(TIMEZONE).strftime('%Y-%m-%d %H:%M:%S') for po in pending_orders[o.ticker])))
-            postpone()
-            continue
-
-        executed, saved = False, False
-        try:
-            order = equity.execute_order(o.ticker, o.currency, amount)
-            executed = True
-
-            with db.connection() as conn, conn.transaction():
-                db.put_orders(order, conn=conn)
-                db.delete_scheduled_order(o, conn=conn)
-                db.drop_leftovers(o.ticker, conn=conn)
-            saved = True
-            logging.info('executed using %s %s', order.amount, order.currency)
-        except SmolOrderException:
-            logging.info('order amount is too small, postponing')
-            postpone()
-        except InsufficientFundsException:
-            logging.info('account balance is insufficient, skipping order')
-            send_message('Account balance is insufficient to execute new orders.')
-            db.delete_scheduled_order(o)
-        finally:
-            if executed and not saved:
-                logging.error('failed to save executed %s order, disabling autoinvest to avoid uncontrolled spendings', o.ticker)
-                send_message(f'Failed to save executed {o.ticker} order, disabling autoinvest to avoid uncontrolled spendings.')
-                db.disable()
+from workers import *
+
+
+def create_workers() -> List[Worker]:
+    # Clients are created once per account, metadata is stored once per mode.
+    accounts = {a.name: a for a in ACCOUNTS}
+    metadata_stores = {}
+    clients = {}
+    workers = []
+    for plan in PLANS:
+        account = accounts[plan.account]
+        if account.name not in clients:
+            logging.info('initializing %s clients', account.name)
+            metadata_store = metadata_stores.setdefault(account.mode, MetadataStore.for_mode(account.mode))
+            clients[account.name] = EquityClient(account), T212ApiClient(account, metadata_store)
+        workers.append(Worker(plan, *clients[account.name], send_message))
+    return workers
+
+
+def register_metrics(workers: List[Worker]):
+    def leftover_samples():
+        for worker in workers:
+            for ticker, amount in worker.store.all_leftovers().items():
+                yield 'autoinvest_leftovers', {'plan': worker.plan.name, 'ticker': ticker}, amount
+
+    def db_pool_samples():
+        for name, value in db.pool_stats().items():
+            if name.startswith('pool_') or name == 'requests_waiting':
+                yield f'autoinvest_db_{name}', {}, value
+            else:
+                yield f'autoinvest_db_pool_{name}_total', {}, value
+
+    metrics.register_collector(leftover_samples)
+    metrics.register_collector(db_pool_samples)
+    metrics.describe('autoinvest_tick_seconds', 'histogram', 'Main loop tick duration.')
+    metrics.describe('autoinvest_tick_stage_seconds', 'histogram', 'Duration of the main loop and pie watcher stages.')
+    metrics.describe('autoinvest_execution_lag_seconds', 'histogram', 'Time between execute_at and the order execution.')
+    metrics.describe('autoinvest_orders_total', 'counter', 'Scheduled orders by outcome.')
+    metrics.describe('autoinvest_leftovers', 'gauge', 'Postponed amounts in master currency.')
+    metrics.describe('autoinvest_db_pool_size', 'gauge', 'Open DB connections.')
+    metrics.describe('autoinvest_db_pool_available', 'gauge', 'Idle DB connections.')
+    metrics.describe('autoinvest_db_requests_waiting', 'gauge', 'Requests waiting for a DB connection.')
+
+
+def run_workers(workers: List[Worker], tick: Callable[[Worker], None]):
+    # Runs until any of the workers stops, the service is then restarted.
+    stopped = threading.Event()
+    Waker.start()
+    for worker in workers:
+        worker.start(tick, on_stop=stopped.set)
+    stopped.wait()
+    for worker in workers:
+        if worker.error:
+            raise worker.error
+
+
+async def main_async(workers: List[Worker]):
+    http = AsyncHttp()
+    clients = {}
+    for worker in workers:
+        if worker.equity not in clients:
+            clients[worker.equity] = AsyncEquityClient(http, worker.equity), AsyncT212ApiClient(http, worker.api_client)
+    loop = asyncio.get_running_loop()
+    for worker in workers:
+        worker.watcher.use_async(clients[worker.equity][1], loop)
+
+    def tick(worker: Worker):
+        async_equity, _ = clients[worker.equity]
+        asyncio.run_coroutine_threadsafe(execute_due_orders_async(worker, async_equity), loop).result()
+
+    try:
+        await asyncio.to_thread(run_workers, workers, tick)
+    finally:
+        await http.close()
 
 
 def main():
     setup_logging(filename='main.log')
-
-    logging.info('initializing clients')
-    equity = EquityClient()
-    api_client = T212ApiClient()
-
-    logging.info('running main loop')
-    while True:
-        if db.enabled():
-            try:
-                run(equity, api_client)
-            except CookiesExpiredException:
-                logging.info('cookies has expired, restarting')
-                return
-            except Exception:
-                logging.error('unexpected error running main loop: %s', traceback.format_exc())
-                send_message(f'Unexpected error running main loop:\n{hpre(traceback.format_exc())}')
-                raise
-        else:
-            db.drop_scheduled_orders()
-
-        time.sleep(60)
+    workers = create_workers()
+    if METRICS_PORT:
+        register_metrics(workers)
+        metrics.serve(METRICS_PORT)
+
+    logging.info('running %s workers', len(workers))
+    Waker.handle_signals()
+    if ASYNC_CLIENTS:
+        asyncio.run(main_async(workers))
+    else:
+        run_workers(workers, execute_due_orders)
 
 
 if __name__ == '__main__':
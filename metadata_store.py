@@ -0,0 +1,94 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import Optional
+
+from dataclasses_json import DataClassJsonMixin, config
+from dateutil.parser import parse
+from pytrading212.constants import Mode
+
+__all__ = [
+    'Snapshot',
+    'MetadataStore',
+    'digest',
+]
+
+
+@dataclass
+class Snapshot(DataClassJsonMixin):
+    digest: str
+    version: int
+    fetched_at: datetime.datetime = field(metadata=config(encoder=datetime.datetime.isoformat, decoder=parse))
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+# Raw T212 metadata responses stored on disk. Each key has a snapshot file
+# describing the response and a content file with the response body. Files are
+# replaced atomically and snapshots written in a different format are ignored.
+class MetadataStore:
+    FORMAT_VERSION = 2
+    DIRECTORY = '.cache/metadata'
+
+    def __init__(self, directory: str = DIRECTORY):
+        self._directory = directory
+
+    @classmethod
+    def for_mode(cls, mode: Mode) -> 'MetadataStore':
+        # Metadata is the same for every account of a mode.
+        return cls(os.path.join(cls.DIRECTORY, mode.name.lower()))
+
+    def load(self, key: str) -> Optional[Snapshot]:
+        try:
+            with open(self._path(key, 'json'), 'r') as f:
+                raw = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.warning('corrupted %s metadata snapshot, ignoring', key)
+            return None
+        if raw.get('format_version') != self.FORMAT_VERSION:
+            logging.info('outdated %s metadata snapshot format, ignoring', key)
+            return None
+        return Snapshot.from_dict(raw['snapshot'])
+
+    def load_content(self, key: str, snapshot: Snapshot) -> Optional[str]:
+        try:
+            with open(self._path(key, 'data'), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        if digest(content) != snapshot.digest:
+            logging.warning('%s metadata content does not match snapshot v%s, ignoring', key, snapshot.version)
+            return None
+        return content.decode()
+
+    def save(self, key: str, snapshot: Snapshot, content: Optional[bytes] = None):
+        os.makedirs(self._directory, exist_ok=True)
+        if content is not None:
+            self._write(self._path(key, 'data'), content)
+        self._write(self._path(key, 'json'), json.dumps({
+            'format_version': self.FORMAT_VERSION,
+            'snapshot': snapshot.to_dict(),
+        }).encode())
+
+    def _write(self, path: str, content: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self._directory, f'{key}.{ext}')
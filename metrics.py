@@ -0,0 +1,184 @@
+import bisect
+import contextlib
+import logging
+import math
+import threading
+import time
+from dataclasses import fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import transport
+from cache import cache_stats
+
+__all__ = [
+    'Sample',
+    'describe',
+    'inc',
+    'observe',
+    'timed',
+    'register_collector',
+    'render',
+    'serve',
+]
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Dict[str, str], float]  # metric name, labels and value
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)  # seconds
+
+_lock = threading.Lock()
+_types: Dict[str, Tuple[str, str]] = {}
+_counters: Dict[Tuple[str, Labels], float] = {}
+_histograms: Dict[Tuple[str, Labels], List[float]] = {}  # bucket counts including +Inf, then count and sum
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+
+
+def describe(name: str, metric_type: str, help_text: str):
+    _types[name] = (metric_type, help_text)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels: str):
+    key = (name, _labels(labels))
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 3)
+        h[bisect.bisect_left(BUCKETS, value)] += 1
+        h[-2] += 1
+        h[-1] += value
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def register_collector(collector: Callable[[], Iterable[Sample]]):
+    # Collectors are called on every scrape for values kept elsewhere.
+    _collectors.append(collector)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name = name + '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+    if math.isinf(value):
+        return f'{name} {"+Inf" if value > 0 else "-Inf"}'
+    return f'{name} {value:g}' if isinstance(value, int) or value.is_integer() else f'{name} {value!r}'
+
+
+def render() -> str:
+    samples: Dict[str, List[str]] = {}
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    for (name, labels), value in sorted(counters.items()):
+        samples.setdefault(name, []).append(_format(name, labels, value))
+    for (name, labels), h in sorted(histograms.items()):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (math.inf,), h):
+            cumulative += count
+            lines.append(_format(f'{name}_bucket', labels + (('le', '+Inf' if math.isinf(bound) else f'{bound:g}'),), cumulative))
+        lines.append(_format(f'{name}_count', labels, h[-2]))
+        lines.append(_format(f'{name}_sum', labels, h[-1]))
+    for collector in list(_collectors):
+        try:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append(_format(name, _labels(labels), value))
+        except Exception:
+            logging.exception('metrics collector %s failed', getattr(collector, '__name__', collector))
+
+    res = []
+    for name in sorted(samples):
+        if name in _types:
+            metric_type, help_text = _types[name]
+            res.append(f'# HELP {name} {help_text}')
+            res.append(f'# TYPE {name} {metric_type}')
+        res.extend(samples[name])
+    return '\n'.join(res) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '127.0.0.1') -> Optional[ThreadingHTTPServer]:
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError:
+        logging.exception('failed to start metrics endpoint on %s:%s', host, port)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info('serving metrics on http://%s:%s/metrics', host, port)
+    return server
+
+
+def _transport_samples() -> Iterable[Sample]:
+    for name, s in transport.stats().items():
+        labels = {'endpoint': name}
+        yield 'autoinvest_http_requests_total', labels, s.requests
+        yield 'autoinvest_http_errors_total', labels, s.errors
+        yield 'autoinvest_http_retries_total', labels, s.retries
+        yield 'autoinvest_http_new_connections_total', labels, s.new_connections
+        yield 'autoinvest_http_request_seconds_total', labels, s.seconds_total
+        yield 'autoinvest_http_request_seconds_max', labels, s.seconds_max
+        yield 'autoinvest_http_response_bytes_total', labels, s.bytes_total
+
+
+def _cache_samples() -> Iterable[Sample]:
+    for name, s in cache_stats().items():
+        labels = {'cache': name}
+        for f in fields(s):
+            if f.name == 'size':
+                yield 'autoinvest_cache_size', labels, s.size
+            elif f.name == 'load_seconds_max':
+                yield 'autoinvest_cache_load_seconds_max', labels, s.load_seconds_max
+            else:
+                yield f'autoinvest_cache_{f.name}_total', labels, getattr(s, f.name)
+        yield 'autoinvest_cache_hit_rate', labels, s.hit_rate
+
+
+register_collector(_transport_samples)
+register_collector(_cache_samples)
+
+describe('autoinvest_http_requests_total', 'counter', 'HTTP requests by endpoint.')
+describe('autoinvest_http_errors_total', 'counter', 'Failed HTTP requests by endpoint.')
+describe('autoinvest_http_retries_total', 'counter', 'Retried HTTP requests by endpoint.')
+describe('autoinvest_http_new_connections_total', 'counter', 'HTTP requests which opened a new connection.')
+describe('autoinvest_http_request_seconds_total', 'counter', 'Time spent in HTTP requests.')
+describe('autoinvest_http_request_seconds_max', 'gauge', 'Slowest HTTP request.')
+describe('autoinvest_http_response_bytes_total', 'counter', 'Received HTTP response bodies.')
+describe('autoinvest_cache_hit_rate', 'gauge', 'Share of cache lookups answered without loading.')
+describe('autoinvest_cache_size', 'gauge', 'Cached entries.')
@@ -0,0 +1,52 @@
+import datetime
+import os
+from dataclasses import dataclass
+from typing import Tuple
+
+from pytrading212.constants import Mode
+
+__all__ = [
+    'Account',
+    'Plan',
+]
+
+
+@dataclass(frozen=True)
+class Account:
+    name: str
+    mode: Mode
+    secrets_dir: str = '.secrets'
+
+    @property
+    def base_url(self) -> str:
+        return f'https://{self.mode.name.lower()}.trading212.com'
+
+    @property
+    def token(self) -> str:
+        return self.secret(f't212_{self.mode.name.lower()}_token')
+
+    @property
+    def email(self) -> str:
+        return self.secret('t212_email')
+
+    @property
+    def password(self) -> str:
+        return self.secret('t212_password')
+
+    def secret(self, name: str) -> str:
+        with open(os.path.join(self.secrets_dir, name), 'r') as f:
+            return f.read().strip()
+
+
+@dataclass(frozen=True)
+class Plan:
+    account: str
+    pie: str
+    weekly_amount: float  # in master currency
+    investment_period: datetime.timedelta
+    master_currency: str
+    currency_priority: Tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return f'{self.account}/{self.pie}'
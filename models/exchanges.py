@@ -1,7 +1,11 @@
+import bisect
 import datetime
+import functools
+import json
+from array import array
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Mapping, Sequence
 
 from dataclasses_json import DataClassJsonMixin
 from dataclasses_json import dataclass_json, LetterCase, config
@@ -10,6 +14,9 @@ from dateutil.parser import parse
 __all__ = [
     'EventType',
     'TimeEvent',
+    'EVENT_CODES',
+    'ScheduleIndex',
+    'WorkingSchedules',
     'WorkingSchedule',
     'Exchange',
 ]
@@ -30,12 +37,97 @@ class TimeEvent(DataClassJsonMixin):
     type: EventType
 
 
+# Event types packed into ScheduleIndex.types.
+EVENT_CODES = {t: code for code, t in enumerate(EventType)}
+_OPEN = EVENT_CODES[EventType.OPEN]
+
+
+class ScheduleIndex:
+    # Event times of a working schedule in order as epoch seconds and their
+    # type codes, the market state at any time is the one set by the last
+    # event before it.
+
+    def __init__(self, times: array, types: array):
+        self.times = times
+        self.types = types
+
+    @classmethod
+    def from_events(cls, time_events: Iterable[TimeEvent]) -> 'ScheduleIndex':
+        events = sorted((e.date.timestamp(), EVENT_CODES[e.type]) for e in time_events)
+        return cls(array('d', [t for t, _ in events]), array('b', [code for _, code in events]))
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def covers(self, t: datetime.datetime) -> bool:
+        return bool(self.times) and self.times[0] < t.timestamp()
+
+    def ends_after(self, t: datetime.datetime) -> bool:
+        return len(self.times) > 1 and self.times[-1] >= t.timestamp()
+
+    def is_open(self, t: datetime.datetime) -> bool:
+        return self.types[max(bisect.bisect_left(self.times, t.timestamp()) - 1, 0)] == _OPEN
+
+    def open_mask(self, times: Sequence[float]) -> List[bool]:
+        # Same as is_open for every time in epoch seconds, sorted times are
+        # matched in one pass.
+        res = []
+        event_times, types = self.times, self.types
+        i, n = 0, len(event_times)
+        for ts in times:
+            while i + 1 < n and event_times[i + 1] < ts:
+                i += 1
+            res.append(types[i] == _OPEN)
+        return res
+
+
+class WorkingSchedules(Mapping[int, ScheduleIndex]):
+    # Schedule indexes of all exchanges by working schedule id, packed straight
+    # from the exchanges response without decoding events into objects.
+
+    def __init__(self, content: str):
+        self._indexes: Dict[int, ScheduleIndex] = {}
+        for ex in json.loads(content):
+            for ws in ex['workingSchedules']:
+                events = sorted((_timestamp(e['date']), EVENT_CODES[EventType(e['type'])]) for e in ws['timeEvents'])
+                self._indexes[ws['id']] = ScheduleIndex(array('d', [t for t, _ in events]),
+                                                        array('b', [code for _, code in events]))
+
+    @classmethod
+    def from_exchanges(cls, exchanges: Iterable['Exchange']) -> 'WorkingSchedules':
+        res = cls('[]')
+        res._indexes = {ws.id: ws.index for ex in exchanges for ws in ex.working_schedules}
+        return res
+
+    def __getitem__(self, ws_id: int) -> ScheduleIndex:
+        return self._indexes[ws_id]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._indexes)
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+
+def _timestamp(date: str) -> float:
+    try:
+        return datetime.datetime.fromisoformat(date).timestamp()
+    except ValueError:
+        return parse(date).timestamp()
+
+
 @dataclass_json(letter_case=LetterCase.CAMEL)
 @dataclass
 class WorkingSchedule(DataClassJsonMixin):
     id: int
     time_events: List[TimeEvent]
 
+    # Built once per decoded schedule, so it's shared by all its instruments
+    # until the metadata changes.
+    @functools.cached_property
+    def index(self) -> ScheduleIndex:
+        return ScheduleIndex.from_events(self.time_events)
+
 
 @dataclass_json(letter_case=LetterCase.CAMEL)
 @dataclass
@@ -1,11 +1,15 @@
 import datetime
+import json
+from array import array
 from dataclasses import dataclass, field
+from typing import Dict, Iterator, Mapping
 
 from dataclasses_json import DataClassJsonMixin, dataclass_json, LetterCase, config
 from dateutil.parser import parse
 
 __all__ = [
     'Instrument',
+    'InstrumentIndex',
 ]
 
 
@@ -22,3 +26,53 @@ class Instrument(DataClassJsonMixin):
     min_trade_quantity: float
     max_open_quantity: float
     added_on: datetime.datetime = field(metadata=config(decoder=parse))
+
+
+_decoder = json.JSONDecoder()
+_SEPARATORS = ' \t\n\r,'
+
+
+class InstrumentIndex(Mapping[str, Instrument]):
+    # Keeps the raw instruments response and the offsets of every instrument
+    # in it, instruments are only decoded when requested. Indexing decodes each
+    # item once to find its ticker and drops it, the response string stays
+    # resident.
+
+    def __init__(self, content: str):
+        self._content = content
+        self._positions: Dict[str, int] = {}
+        self._starts = array('q')
+        self._ends = array('q')
+        self._decoded: Dict[str, Instrument] = {}
+
+        pos = self._skip(0)
+        if content[pos] != '[':
+            raise ValueError('instruments response is not a list')
+        pos = self._skip(pos + 1)
+        while content[pos] != ']':
+            item, end = _decoder.raw_decode(content, pos)
+            self._positions[item['ticker']] = len(self._starts)
+            self._starts.append(pos)
+            self._ends.append(end)
+            pos = self._skip(end)
+
+    def __getitem__(self, ticker: str) -> Instrument:
+        if (inst := self._decoded.get(ticker)) is None:
+            i = self._positions[ticker]
+            inst = Instrument.from_dict(json.loads(self._content[self._starts[i]:self._ends[i]]))
+            self._decoded[ticker] = inst
+        return inst
+
+    def __contains__(self, ticker: object) -> bool:
+        return ticker in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _skip(self, pos: int) -> int:
+        while self._content[pos] in _SEPARATORS:
+            pos += 1
+        return pos
@@ -1,5 +1,6 @@
 import datetime
 from dataclasses import dataclass, field, replace
+from typing import Optional
 
 from dataclasses_json import dataclass_json, LetterCase, config, DataClassJsonMixin
 from dateutil.parser import parse
@@ -7,6 +8,8 @@ from dateutil.parser import parse
 __all__ = [
     'Order',
     'ScheduledOrder',
+    'LedgerEntry',
+    'OrderOutcome',
 ]
 
 
@@ -17,6 +20,7 @@ class Order(DataClassJsonMixin):
     amount: float = field(metadata=config(field_name="value"))
     currency: str = field(metadata=config(field_name="currencyCode"))
     created_at: datetime.datetime = field(metadata=config(field_name="created", decoder=parse))
+    fx_rate: Optional[float] = None  # master currency to order currency rate used for the order
 
 
 @dataclass
@@ -29,3 +33,22 @@ class ScheduledOrder:
     def __str__(self):
         execute_at_str = self.execute_at.replace(microsecond=0).astimezone(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
         return repr(replace(self, execute_at=execute_at_str))
+
+
+# Amount scheduled for a ticker in the week since week_start and the time
+# orders are generated until.
+@dataclass
+class LedgerEntry:
+    ticker: str
+    week_start: datetime.datetime
+    amount: float  # in master currency
+    scheduled_until: datetime.datetime
+
+
+# What happened to a scheduled order: executed as order, postponed to
+# leftovers or otherwise skipped.
+@dataclass
+class OrderOutcome:
+    scheduled_order: ScheduledOrder
+    order: Optional[Order] = None
+    postponed: bool = False
@@ -0,0 +1,68 @@
+import datetime
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+from config import *
+from models.orders import Order
+from utils import *
+
+__all__ = [
+    'PendingOrderTracker',
+]
+
+
+# Local view of pending orders, reconciled with the account summary every
+# PENDING_ORDERS_RECONCILE_INTERVAL, or sooner if it's marked inconsistent.
+# Orders the summary reports are pending until the next reconciliation.
+# Orders placed by the bot are expected to be filled within PENDING_ORDER_GRACE,
+# after that they count as pending until a reconciliation shows they've been.
+class PendingOrderTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._placed: Dict[str, List[Order]] = {}
+        self._confirmed: Dict[str, List[Order]] = {}
+        self._reconciled_at: Optional[datetime.datetime] = None
+
+    def add(self, order: Order):
+        with self._lock:
+            self._placed.setdefault(order.ticker, []).append(order)
+
+    def get(self, ticker: str) -> List[Order]:
+        with self._lock:
+            t = now()
+            overdue = [o for o in self._placed.get(ticker, []) if t - o.created_at >= PENDING_ORDER_GRACE]
+            return self._confirmed.get(ticker, []) + overdue
+
+    def reconcile_due(self) -> bool:
+        return self._reconciled_at is None or now() - self._reconciled_at >= PENDING_ORDERS_RECONCILE_INTERVAL
+
+    def mark_inconsistent(self):
+        self._reconciled_at = None
+
+    # Concurrent callers share the summary fetched by the first one.
+    def reconcile_if_due(self, fetch: Callable[[], Iterable[Order]]):
+        with self._reconcile_lock:
+            if self.reconcile_due():
+                self.reconcile(fetch())
+
+    def reconcile(self, pending_orders: Iterable[Order]):
+        with self._lock:
+            t = now()
+            # Orders still within the grace period are left to the next reconciliation.
+            placed = {}
+            for ticker, orders in self._placed.items():
+                if recent := [o for o in orders if t - o.created_at < PENDING_ORDER_GRACE]:
+                    placed[ticker] = recent
+            confirmed = {}
+            for o in pending_orders:
+                if o.ticker in placed and t - o.created_at < PENDING_ORDER_GRACE:
+                    continue
+                confirmed.setdefault(o.ticker, []).append(o)
+            unknown = [ticker for ticker in confirmed if ticker not in self._placed and ticker not in self._confirmed]
+            if unknown:
+                logging.info('found pending orders not placed by autoinvest: %s', ', '.join(sorted(unknown)))
+            self._confirmed = confirmed
+            self._placed = placed
+            self._reconciled_at = t
@@ -1,110 +1,276 @@
+import bisect
 import datetime
+import functools
+import logging
+import math
 import random
-from dataclasses import dataclass
-from typing import List
+from array import array
+from dataclasses import dataclass, replace
+from typing import Dict, List, Tuple
 
-import db
 from api_client import T212ApiClient
-from models.exchanges import EventType
-from models.exchanges import WorkingSchedule
-from models.orders import ScheduledOrder
-from models.pies import Pie
+from config import *
+from models import instruments, pies
+from models.exchanges import ScheduleIndex
+from models.orders import LedgerEntry, ScheduledOrder
 from utils import *
 
 __all__ = [
     'Instrument',
     'collect_instruments',
-    'schedule_orders',
+    'min_order_amount',
+    'week_start',
+    'week_slots',
+    'seed_ledger',
+    'extend_schedule',
     'validate_orders',
+    'Changes',
+    'rescale_orders',
+    'move_closed_orders',
 ]
 
+WEEK = datetime.timedelta(days=7)
+
+# Scheduled orders to delete and to put, an order is updated by deleting it
+# and putting its new version.
+Changes = Tuple[List[ScheduledOrder], List[ScheduledOrder]]
+
 
 @dataclass
 class Instrument:
     ticker: str
-    working_schedule: WorkingSchedule
+    schedule: ScheduleIndex
     currency_code: str
     short_name: str
     expected_share: float
+    min_order_amount: float = 0.0  # estimated, in master currency
 
 
-def collect_instruments(client: T212ApiClient, pie: Pie) -> List[Instrument]:
-    exchange_info = client.get_exchange_info()
-    working_schedules = {}
-    for ex in exchange_info.values():
-        for ws in ex.working_schedules:
-            working_schedules[ws.id] = ws
+def collect_instruments(client: T212ApiClient, pie: pies.Pie) -> List[Instrument]:
+    schedules = client.get_working_schedules()
+    instrument_info = client.get_instrument_info()
 
     detailed_instruments = []
-
-    instrument_info = client.get_instrument_info()
     for inst in pie.instruments:
         inst_info = instrument_info[inst.ticker]
         detailed_instruments.append(Instrument(
             ticker=inst_info.ticker,
-            working_schedule=working_schedules[inst_info.working_schedule_id],
+            schedule=schedules[inst_info.working_schedule_id],
             currency_code=inst_info.currency_code,
             short_name=inst_info.short_name,
             expected_share=inst.expected_share,
+            min_order_amount=min_order_amount(inst, inst_info),
         ))
 
     return detailed_instruments
 
 
-def schedule_orders(pie_instruments: List[Instrument], weekly_amount: float, period: datetime.timedelta) -> List[ScheduledOrder]:
-    order_since = now()
-    order_until = order_since + datetime.timedelta(days=7)
+def min_order_amount(inst: pies.Instrument, inst_info: instruments.Instrument) -> float:
+    # Minimum tradable quantity at the price implied by the pie's holding, pie
+    # values are in the account currency which is assumed to be the master
+    # currency. Unknown without a holding.
+    if inst.owned_quantity <= 0 or inst.result.value <= 0:
+        return 0.0
+    return round(inst_info.min_trade_quantity * inst.result.value / inst.owned_quantity, 2)
+
 
-    order_times = []
-    cur_time = order_since + period
-    while cur_time <= order_until:
-        order_times.append(cur_time)
-        cur_time += period
-    order_times = [t + datetime.timedelta(seconds=(period.total_seconds() / 6) * random.random()) for t in order_times]
+def week_start(t: datetime.datetime) -> datetime.datetime:
+    t = t.astimezone(TIMEZONE)
+    return (t - datetime.timedelta(days=t.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
 
-    if not order_times:
+
+@functools.lru_cache(maxsize=8)
+def week_slots(start: datetime.datetime, period: datetime.timedelta, seed: str
+               ) -> Tuple[List[datetime.datetime], array]:
+    # Order times of a week and their epoch seconds, every period since its
+    # start with up to a sixth of the period of jitter. The jitter only depends
+    # on the slot, so the same slots are generated whenever the week is extended.
+    max_jitter = period.total_seconds() / 6
+    times, stamps = [], array('d')
+    k = 0
+    while k * period + datetime.timedelta(seconds=max_jitter) < WEEK:
+        t = start + k * period
+        ts = t.timestamp()
+        jitter = random.Random(f'{seed}/{ts}').random() * max_jitter
+        times.append(t + datetime.timedelta(seconds=jitter))
+        stamps.append(ts + jitter)
+        k += 1
+    if not times:
         raise ValueError('empty order times, adjust period')
+    return times, stamps
 
-    res = []
 
+def seed_ledger(pie_instruments: List[Instrument], scheduled_orders: List[ScheduledOrder],
+                weekly_amount: float) -> List[LedgerEntry]:
+    # Ledger entries of tickers with orders scheduled before the ledger existed,
+    # a week ahead of when they were scheduled. The week of a ticker's last
+    # order counts the orders in it and its elapsed part as scheduled, so the
+    # ledger continues after the last order without investing twice.
+    t_now = now()
+    res = []
     for inst in pie_instruments:
-        events = inst.working_schedule.time_events
-        event_idx = 0
+        if not (orders := [o for o in scheduled_orders if o.ticker == inst.ticker]):
+            continue
+        until = max(o.execute_at for o in orders)
+        start = week_start(until)
+        amount = sum(o.amount for o in orders if o.execute_at >= start)
+        if t_now > start:
+            amount += weekly_amount * inst.expected_share * ((t_now - start) / WEEK)
+        res.append(LedgerEntry(ticker=inst.ticker, week_start=start, amount=round(amount, 2), scheduled_until=until))
+    return res
 
-        inst_order_times = []
-        for order_time in order_times:
-            while event_idx + 1 < len(events) and events[event_idx + 1].date < order_time:
-                event_idx += 1
-            assert events[event_idx].date < order_time, 'exchange schedule does not cover all orders'
-            if events[event_idx].type is not EventType.OPEN:
-                continue
-            inst_order_times.append(order_time)
 
-        if not inst_order_times:
-            raise ValueError(f'couldn\'t prepare order schedule for {inst.short_name}')
+def extend_schedule(pie_instruments: List[Instrument], ledger: Dict[str, LedgerEntry], weekly_amount: float,
+                    period: datetime.timedelta, until: datetime.datetime, seed: str
+                    ) -> Tuple[List[ScheduledOrder], List[LedgerEntry]]:
+    # Generates orders for the open slots up to until, which weren't generated
+    # yet. Every order gets an equal part of what's left of the ticker's weekly
+    # budget, so the budget is spent exactly by the last open slot of the week.
+    # Merged slots are only generated once the order covering them is, so the
+    # ledger's scheduled_until is the time of the last generated order.
+    # Tickers without a ledger entry join with the part of the week that's left.
+    # Returns new orders and updated ledger entries.
+    t_now = now()
+    until_ts = until.timestamp()
+    orders, entries = [], []
+    for inst in pie_instruments:
+        budget = weekly_amount * inst.expected_share
+        index = inst.schedule
+        entry = ledger.get(inst.ticker)
+        if entry is None:
+            start = week_start(t_now)
+            entry = LedgerEntry(ticker=inst.ticker, week_start=start, amount=round(budget * ((t_now - start) / WEEK), 2),
+                                scheduled_until=t_now)
+        updated = replace(entry, scheduled_until=max(entry.scheduled_until, t_now))
+
+        since = updated.scheduled_until
+        assert index.covers(since), 'exchange schedule does not cover all orders'
+        while since < until:
+            start = week_start(since)
+            if start > updated.week_start:
+                updated = replace(updated, week_start=start, amount=0.0, scheduled_until=start)
+            # Only slots after since are checked, the ones up to the end of
+            # the week are needed to split what's left of the budget.
+            times, stamps = week_slots(start, period, seed)
+            i = bisect.bisect_right(stamps, since.timestamp())
+            open_slots = [k for k, is_open in enumerate(index.open_mask(stamps[i:]), i) if is_open]
+            remaining = len(open_slots)
 
-        total_amount = weekly_amount * inst.expected_share
-        amount_per_order = total_amount / len(inst_order_times)
+            # Slots whose share is below the minimum order amount are merged,
+            # an order is placed every step open slots counting from the last
+            # one of the week and covers all slots since the previous order.
+            step = 1
+            if remaining and inst.min_order_amount and (share := (budget - updated.amount) / remaining) > 0:
+                step = min(remaining, math.ceil(inst.min_order_amount / share))
 
-        res.extend([ScheduledOrder(
-            ticker=inst.ticker,
-            currency=inst.currency_code,
-            amount=round(amount_per_order, 2),
-            execute_at=t,
-        ) for t in inst_order_times])
+            merged = 0
+            for j, k in enumerate(open_slots):
+                if stamps[k] > until_ts:
+                    break
+                t = times[k]
+                merged += 1
+                last = j == len(open_slots) - 1
+                if not last and (merged < step or (len(open_slots) - 1 - j) % step):
+                    continue
+                amount = round((budget - updated.amount) * merged / remaining, 2)
+                remaining -= merged
+                merged = 0
+                updated.scheduled_until = t
+                if amount <= 0:
+                    continue
+                updated.amount = round(updated.amount + amount, 2)
+                orders.append(ScheduledOrder(
+                    ticker=inst.ticker,
+                    currency=inst.currency_code,
+                    amount=amount,
+                    execute_at=t,
+                ))
+            # Half a day past the week end is in the next week whatever the DST shift.
+            since = min(until, week_start(start + WEEK + datetime.timedelta(hours=12)))
 
-    return sorted(res, key=lambda x: (x.execute_at, x.ticker))
+        if updated != entry or inst.ticker not in ledger:
+            entries.append(updated)
+    return sorted(orders, key=lambda x: (x.execute_at, x.ticker)), entries
 
 
-def validate_orders(pie_instruments: List[Instrument]) -> bool:
+def validate_orders(pie_instruments: List[Instrument], scheduled_orders: List[ScheduledOrder]) -> bool:
     pie_instruments = {inst.ticker: inst for inst in pie_instruments}
-    scheduled_orders = db.scheduled_orders()
+    t_now = now()
     for o in scheduled_orders:
-        events = pie_instruments[o.ticker].working_schedule.time_events
-        for event, next_event in zip(events, events[1:]):
-            if next_event.date < o.execute_at:
-                continue
-            if event.type is not EventType.OPEN:
-                return False
-            break
+        index = pie_instruments[o.ticker].schedule
+        # Orders after the end of the schedule can't be checked yet, due ones
+        # are left to the execution.
+        if o.execute_at > t_now and index.ends_after(o.execute_at) and not index.is_open(o.execute_at):
+            return False
     return True
+
+
+def rescale_orders(scheduled_orders: List[ScheduledOrder], ledger: Dict[str, LedgerEntry],
+                   old_amounts: Dict[str, float], new_amounts: Dict[str, float]
+                   ) -> Tuple[List[ScheduledOrder], List[ScheduledOrder], Dict[str, LedgerEntry]]:
+    # Amounts are weekly amounts per ticker. Orders and ledger entries of
+    # removed tickers are deleted, orders of tickers with a changed amount are
+    # scaled and their ledger entries account for the difference, so the rest
+    # of the week makes up for the orders already executed. Due orders may be
+    # executing right now and keep their amount.
+    t_now = now()
+    deleted, added = [], []
+    ledger = {ticker: replace(entry) for ticker, entry in ledger.items() if new_amounts.get(ticker)}
+    for o in scheduled_orders:
+        old_amount, new_amount = old_amounts.get(o.ticker), new_amounts.get(o.ticker)
+        if not new_amount:
+            deleted.append(o)
+        elif o.execute_at > t_now and old_amount and (amount := round(o.amount * new_amount / old_amount, 2)) != o.amount:
+            deleted.append(o)
+            added.append(replace(o, amount=amount))
+            if (entry := ledger.get(o.ticker)) is not None:
+                entry.amount = round(entry.amount + amount - o.amount, 2)
+    return deleted, added, ledger
+
+
+def move_closed_orders(pie_instruments: List[Instrument], scheduled_orders: List[ScheduledOrder]) -> Changes:
+    # Orders scheduled when the market is closed move to the nearest open time
+    # other orders are scheduled at, or are merged into the nearest order of
+    # the same ticker if there is no such time. Due orders may be executing
+    # right now and are neither moved nor merged into.
+    t_now = now()
+    pie_instruments = {inst.ticker: inst for inst in pie_instruments}
+    scheduled_orders = [o for o in scheduled_orders if o.execute_at > t_now]
+    order_times = sorted({o.execute_at for o in scheduled_orders})
+    taken: Dict[str, Dict[datetime.datetime, ScheduledOrder]] = {}
+    for o in scheduled_orders:
+        taken.setdefault(o.ticker, {})[o.execute_at] = o
+
+    deleted, added = [], []
+    for o in scheduled_orders:
+        index = pie_instruments[o.ticker].schedule
+        if not index.ends_after(o.execute_at) or index.is_open(o.execute_at):
+            continue
+        ticker_orders = taken[o.ticker]
+        del ticker_orders[o.execute_at]
+        deleted.append(o)
+
+        free_times = [t for t in order_times if t not in ticker_orders and index.is_open(t)]
+        if free_times:
+            t = _nearest(free_times, o.execute_at)
+            moved = ticker_orders[t] = replace(o, execute_at=t)
+            added.append(moved)
+            logging.info('moving %s order from %s to %s', o.ticker, o.execute_at, t)
+        elif open_times := sorted(t for t in ticker_orders if not index.ends_after(t) or index.is_open(t)):
+            t = _nearest(open_times, o.execute_at)
+            merged = replace(ticker_orders[t], amount=round(ticker_orders[t].amount + o.amount, 2))
+            if ticker_orders[t] in added:
+                added.remove(ticker_orders[t])
+            else:
+                deleted.append(ticker_orders[t])
+            added.append(merged)
+            ticker_orders[t] = merged
+            logging.info('merging %s order at %s into the one at %s', o.ticker, o.execute_at, t)
+        else:
+            logging.warning('no open time left for %s order at %s, dropping it', o.ticker, o.execute_at)
+    return deleted, added
+
+
+def _nearest(times: List[datetime.datetime], t: datetime.datetime) -> datetime.datetime:
+    i = bisect.bisect_left(times, t)
+    return min(times[max(i - 1, 0):i + 1], key=lambda x: abs(x - t))
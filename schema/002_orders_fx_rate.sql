@@ -0,0 +1,4 @@
+\c autoinvest
+
+
+alter table orders add column fx_rate double precision;
@@ -0,0 +1,30 @@
+\c autoinvest
+
+
+-- Existing rows belong to the default account and pie from config.py.
+
+alter table scheduled_orders add column account varchar(64) not null default 'default';
+alter table scheduled_orders add column pie varchar(64) not null default 'autoinvest';
+alter table scheduled_orders drop constraint scheduled_orders_pkey;
+alter table scheduled_orders add primary key (account, pie, ticker, execute_at);
+alter table scheduled_orders alter column account drop default;
+alter table scheduled_orders alter column pie drop default;
+
+alter table orders add column account varchar(64) not null default 'default';
+alter table orders add column pie varchar(64) not null default 'autoinvest';
+alter table orders alter column account drop default;
+alter table orders alter column pie drop default;
+
+alter table leftovers add column account varchar(64) not null default 'default';
+alter table leftovers add column pie varchar(64) not null default 'autoinvest';
+alter table leftovers drop constraint leftovers_pkey;
+alter table leftovers add primary key (account, pie, ticker);
+alter table leftovers alter column account drop default;
+alter table leftovers alter column pie drop default;
+
+alter table state add column account varchar(64) not null default 'default';
+alter table state add column pie varchar(64) not null default 'autoinvest';
+alter table state drop constraint state_pkey;
+alter table state add primary key (account, pie, key);
+alter table state alter column account drop default;
+alter table state alter column pie drop default;
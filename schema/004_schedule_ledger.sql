@@ -0,0 +1,15 @@
+\c autoinvest
+
+
+-- Amount scheduled for each ticker in the current week and the time orders
+-- are generated until, orders are generated ahead for SCHEDULE_LOOKAHEAD.
+create table schedule_ledger (
+    account           varchar(64)                not null,
+    pie               varchar(64)                not null,
+    ticker            varchar(64)                not null,
+    week_start        timestamp with time zone   not null,
+    amount            double precision           not null,
+    scheduled_until   timestamp with time zone   not null,
+
+    primary key (account, pie, ticker)
+);
@@ -0,0 +1,353 @@
+import argparse
+import datetime
+import json
+import logging
+import time
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from dateutil.parser import parse
+
+from config import *
+from equity_client import SmolOrderException, InsufficientFundsException
+from metadata_store import MetadataStore
+from models import exchanges, instruments, pies
+from models.accounts import Account, Plan
+from models.orders import LedgerEntry, Order, OrderOutcome, ScheduledOrder
+from pending_orders import PendingOrderTracker
+from state_mirror import PlanStore
+from utils import *
+from workers import Worker, run
+
+__all__ = [
+    'SimulatedClock',
+    'MemoryStore',
+    'FakeApiClient',
+    'FakeEquityClient',
+    'SimulatedWorker',
+    'Report',
+    'simulate',
+]
+
+WEEK = datetime.timedelta(days=7)
+
+
+class SimulatedClock(Clock):
+    def __init__(self, t: datetime.datetime):
+        self.t = t
+
+    def now(self) -> datetime.datetime:
+        return self.t
+
+
+# Plan store kept in memory, also counts scheduled orders which were not executed.
+class MemoryStore(PlanStore):
+    def __init__(self, plan: Plan):
+        super().__init__(plan)
+        self._scheduled_orders: Dict[Tuple[str, datetime.datetime], ScheduledOrder] = {}
+        self._leftovers: Dict[str, float] = {}
+        self._state: List[Tuple[str, str]] = []
+        self._ledger: Dict[str, LedgerEntry] = {}
+        self.postponed: Dict[str, int] = {}
+        self.skipped: Dict[str, int] = {}
+        self.expired: Dict[str, int] = {}
+
+    def scheduled_orders(self) -> List[ScheduledOrder]:
+        return sorted(self._scheduled_orders.values(), key=lambda o: (o.execute_at, o.ticker))
+
+    def scheduled_orders_to_execute(self) -> List[ScheduledOrder]:
+        t = now()
+        return [o for o in self.scheduled_orders() if o.execute_at <= t]
+
+    def next_order_scheduled_for(self) -> Optional[datetime.datetime]:
+        return min((o.execute_at for o in self._scheduled_orders.values()), default=None)
+
+    def leftovers(self, ticker: str) -> float:
+        return self._leftovers.get(ticker, 0.0)
+
+    def all_leftovers(self) -> Dict[str, float]:
+        return dict(self._leftovers)
+
+    def state(self) -> List[Tuple[str, str]]:
+        return list(self._state)
+
+    def ledger(self) -> Dict[str, LedgerEntry]:
+        return {ticker: replace(e) for ticker, e in self._ledger.items()}
+
+    def put_scheduled_orders(self, *orders: ScheduledOrder):
+        for o in orders:
+            self._scheduled_orders[(o.ticker, o.execute_at)] = o
+
+    def drop_scheduled_orders(self):
+        self._scheduled_orders.clear()
+        self._ledger.clear()
+
+    def drop_expired_scheduled_orders(self):
+        before = now() - self.plan.investment_period
+        for key, o in list(self._scheduled_orders.items()):
+            if o.execute_at < before:
+                del self._scheduled_orders[key]
+                self.expired[o.ticker] = self.expired.get(o.ticker, 0) + 1
+
+    def delete_scheduled_order(self, order: ScheduledOrder):
+        if self._scheduled_orders.pop((order.ticker, order.execute_at), None) is not None:
+            self.skipped[order.ticker] = self.skipped.get(order.ticker, 0) + 1
+
+    def replace_scheduled_orders(self, deleted: List[ScheduledOrder], added: List[ScheduledOrder]):
+        for o in deleted:
+            self._scheduled_orders.pop((o.ticker, o.execute_at), None)
+        self.put_scheduled_orders(*added)
+
+    def extend_schedule(self, orders: List[ScheduledOrder], entries: List[LedgerEntry]):
+        self.put_scheduled_orders(*orders)
+        self._ledger.update({e.ticker: replace(e) for e in entries})
+
+    def save_executed_order(self, order: Order, scheduled_order: ScheduledOrder):
+        self._scheduled_orders.pop((scheduled_order.ticker, scheduled_order.execute_at), None)
+        self._leftovers.pop(scheduled_order.ticker, None)
+
+    def postpone_scheduled_order(self, order: ScheduledOrder):
+        self._scheduled_orders.pop((order.ticker, order.execute_at), None)
+        self._leftovers[order.ticker] = self._leftovers.get(order.ticker, 0.0) + order.amount
+        self.postponed[order.ticker] = self.postponed.get(order.ticker, 0) + 1
+
+    def save_outcomes(self, outcomes: List[OrderOutcome]):
+        for outcome in outcomes:
+            if outcome.order is not None:
+                self.save_executed_order(outcome.order, outcome.scheduled_order)
+            elif outcome.postponed:
+                self.postpone_scheduled_order(outcome.scheduled_order)
+            else:
+                self.delete_scheduled_order(outcome.scheduled_order)
+
+    def update_state(self, state: List[Tuple[str, str]],
+                     deleted: List[ScheduledOrder] = (), added: List[ScheduledOrder] = (),
+                     ledger: Optional[Dict[str, LedgerEntry]] = None):
+        self._state = list(state)
+        self.replace_scheduled_orders(deleted, added)
+        if ledger is not None:
+            self._ledger = {ticker: replace(e) for ticker, e in ledger.items()}
+
+
+def repeat_weekly(ws: exchanges.WorkingSchedule, since: datetime.datetime, until: datetime.datetime) -> exchanges.WorkingSchedule:
+    # Recorded schedules only cover a couple of weeks, the first recorded week
+    # is repeated to cover the simulated period. Holidays and DST changes of
+    # the recorded week are repeated too.
+    events = sorted(ws.time_events, key=lambda e: e.date)
+    if not events:
+        return ws
+    first = events[0].date
+    week = [e for e in events if e.date < first + WEEK]
+    k = (since - first) // WEEK - 1
+    res = []
+    while first + k * WEEK <= until:
+        res.extend(replace(e, date=e.date + k * WEEK) for e in week)
+        k += 1
+    return exchanges.WorkingSchedule(id=ws.id, time_events=res)
+
+
+# Serves a fixed pie and recorded exchange schedules, which are repeated
+# around the simulated time.
+class FakeApiClient:
+    def __init__(self, pie: pies.Pie, exchange_info: Dict[int, exchanges.Exchange],
+                 instrument_info: Mapping[str, instruments.Instrument]):
+        self.pie = pie
+        self._exchange_info = exchange_info
+        self._instrument_info = instrument_info
+        self._week: Optional[int] = None
+        self._repeated: Dict[int, exchanges.Exchange] = {}
+        self._schedules = exchanges.WorkingSchedules('[]')
+
+    def find_pie(self, name: str) -> Optional[pies.Pie]:
+        return self.pie if self.pie.settings.name == name else None
+
+    def get_exchange_info(self) -> Dict[int, exchanges.Exchange]:
+        # Schedules cover the previous, current and next two weeks, orders are
+        # scheduled for the rest of the current week and the lookahead at most.
+        t = now()
+        week = (t - datetime.datetime(1970, 1, 5, tzinfo=datetime.timezone.utc)) // WEEK
+        if week != self._week:
+            since, until = t - WEEK, t + 2 * WEEK
+            self._repeated = {
+                ex_id: replace(ex, working_schedules=[repeat_weekly(ws, since, until) for ws in ex.working_schedules])
+                for ex_id, ex in self._exchange_info.items()
+            }
+            self._schedules = exchanges.WorkingSchedules.from_exchanges(self._repeated.values())
+            self._week = week
+        return self._repeated
+
+    def get_working_schedules(self) -> Mapping[int, exchanges.ScheduleIndex]:
+        self.get_exchange_info()
+        return self._schedules
+
+    def get_instrument_info(self) -> Mapping[str, instruments.Instrument]:
+        return self._instrument_info
+
+    def metadata_version(self) -> Tuple[Tuple[str, int], ...]:
+        return ()
+
+
+# Fills every order instantly. Orders below the minimum value are rejected
+# as smol, orders are rejected for insufficient funds once funds run out.
+class FakeEquityClient:
+    def __init__(self, account: Account, fx_rates: Dict[str, float], min_order_value: float = 1.0,
+                 funds: Optional[float] = None):
+        self.account = account
+        self.pending = PendingOrderTracker()
+        self.fx_rates = fx_rates
+        self.min_order_value = min_order_value
+        self.funds = funds
+        self.orders: List[Order] = []
+
+    def pending_orders_for(self, ticker: str) -> List[Order]:
+        return []
+
+    def execute_order(self, ticker: str, currency: str, amount: float,
+                      master_currency: str, currency_priority: Tuple[str, ...]) -> Optional[Order]:
+        fx_rate = 1.0 if currency == master_currency else self.fx_rates.get(currency, 1.0)
+        value = round(amount * fx_rate, 2)
+        if value < self.min_order_value:
+            raise SmolOrderException(f'{value} {currency} is less than the minimum order value')
+        if self.funds is not None:
+            if self.funds < amount:
+                raise InsufficientFundsException()
+            self.funds -= amount
+        order = Order(ticker=ticker, amount=value, currency=currency, created_at=now(), fx_rate=fx_rate)
+        self.orders.append(order)
+        return order
+
+
+class SimulatedWorker(Worker):
+    # Runs the real workers.run() stages without the DB, threads or Telegram.
+
+    def __init__(self, plan: Plan, equity: FakeEquityClient, api_client: FakeApiClient):
+        self.messages: List[str] = []
+        super().__init__(plan, equity, api_client, self.messages.append, MemoryStore(plan))
+
+
+@dataclass
+class Report:
+    ticks: int
+    elapsed: float  # wall clock seconds
+    invested: Dict[str, float] = field(default_factory=dict)  # in master currency
+    orders: Dict[str, int] = field(default_factory=dict)
+    leftovers: Dict[str, float] = field(default_factory=dict)
+    postponed: Dict[str, int] = field(default_factory=dict)  # smol orders
+    skipped: Dict[str, int] = field(default_factory=dict)  # insufficient funds
+    expired: Dict[str, int] = field(default_factory=dict)  # not executed in time
+    messages: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        tickers = sorted(set(self.invested) | set(self.leftovers) | set(self.postponed) | set(self.skipped) | set(self.expired))
+        lines = [
+            f'{self.ticks} ticks in {self.elapsed:.1f}s',
+            f'{"ticker":<16}{"invested":>12}{"orders":>8}{"leftovers":>12}{"postponed":>11}{"skipped":>9}{"expired":>9}',
+        ]
+        for ticker in tickers:
+            lines.append(
+                f'{ticker:<16}{self.invested.get(ticker, 0.0):>12.2f}{self.orders.get(ticker, 0):>8}'
+                f'{self.leftovers.get(ticker, 0.0):>12.2f}{self.postponed.get(ticker, 0):>11}'
+                f'{self.skipped.get(ticker, 0):>9}{self.expired.get(ticker, 0):>9}'
+            )
+        lines.append(f'{"total":<16}{sum(self.invested.values()):>12.2f}{sum(self.orders.values()):>8}'
+                     f'{sum(self.leftovers.values()):>12.2f}{sum(self.postponed.values()):>11}'
+                     f'{sum(self.skipped.values()):>9}{sum(self.expired.values()):>9}')
+        lines.extend(f'message: {m}' for m in self.messages)
+        return '\n'.join(lines)
+
+
+def simulate(worker: SimulatedWorker, since: datetime.datetime, until: datetime.datetime,
+             tick: datetime.timedelta) -> Report:
+    clock = SimulatedClock(since)
+    previous = set_clock(clock)
+    started = time.perf_counter()
+    ticks = 0
+    try:
+        while clock.t < until:
+            run(worker)
+            ticks += 1
+            clock.t += tick
+    finally:
+        set_clock(previous)
+
+    store = worker.store
+    report = Report(
+        ticks=ticks,
+        elapsed=time.perf_counter() - started,
+        leftovers=store.all_leftovers(),
+        postponed=dict(store.postponed),
+        skipped=dict(store.skipped),
+        expired=dict(store.expired),
+        messages=list(worker.messages),
+    )
+    for o in worker.equity.orders:
+        report.invested[o.ticker] = report.invested.get(o.ticker, 0.0) + o.amount / o.fx_rate
+        report.orders[o.ticker] = report.orders.get(o.ticker, 0) + 1
+    return report
+
+
+def load_metadata(store: MetadataStore) -> Tuple[Dict[int, exchanges.Exchange], Mapping[str, instruments.Instrument]]:
+    res = []
+    for key in ['exchanges', 'instruments']:
+        snapshot = store.load(key)
+        content = snapshot and store.load_content(key, snapshot)
+        if content is None:
+            raise ValueError(f'no recorded {key} metadata, run autoinvest to record it first')
+        res.append(content)
+    exchange_content, instrument_content = res
+    exchange_info = {e['id']: exchanges.Exchange.from_dict(e) for e in json.loads(exchange_content)}
+    return exchange_info, instruments.InstrumentIndex(instrument_content)
+
+
+def build_pie(name: str, shares: Dict[str, float]) -> pies.Pie:
+    return pies.Pie(
+        instruments=[pies.Instrument(
+            ticker=ticker,
+            result=pies.Result(invested_value=0.0, value=0.0, result=0.0, result_coef=0.0),
+            expected_share=share,
+            current_share=share,
+            owned_quantity=0.0,
+        ) for ticker, share in shares.items()],
+        settings=pies.Settings(
+            id=0,
+            name=name,
+            creation_date=now(),
+            dividend_cash_action=pies.DividendCashAction.REINVEST,
+        ),
+    )
+
+
+def parse_pairs(values: List[str]) -> Dict[str, float]:
+    return {k: float(v) for k, v in (value.split('=', 1) for value in values)}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Simulate autoinvest against recorded exchange schedules.')
+    parser.add_argument('instruments', nargs='+', metavar='TICKER=SHARE', help='pie composition')
+    parser.add_argument('--plan', default=PLANS[0].name, help='plan to take the amounts and currencies from')
+    parser.add_argument('--metadata', help='recorded metadata directory, defaults to the one of the plan mode')
+    parser.add_argument('--since', type=parse, help='defaults to now')
+    parser.add_argument('--days', type=float, default=28)
+    parser.add_argument('--tick', type=float, default=60, help='minutes between ticks')
+    parser.add_argument('--fx-rate', action='append', default=[], metavar='CURRENCY=RATE', help='master currency rate')
+    parser.add_argument('--min-order-value', type=float, default=1.0)
+    parser.add_argument('--funds', type=float, help='available funds in master currency, unlimited by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    plan = next(p for p in PLANS if p.name == args.plan)
+    account = next(a for a in ACCOUNTS if a.name == plan.account)
+    metadata_store = MetadataStore(args.metadata) if args.metadata else MetadataStore.for_mode(account.mode)
+    exchange_info, instrument_info = load_metadata(metadata_store)
+
+    since = (args.since or now()).astimezone(TIMEZONE)
+    worker = SimulatedWorker(
+        plan,
+        FakeEquityClient(account, parse_pairs(args.fx_rate), args.min_order_value, args.funds),
+        FakeApiClient(build_pie(plan.pie, parse_pairs(args.instruments)), exchange_info, instrument_info),
+    )
+    print(simulate(worker, since, since + datetime.timedelta(days=args.days), datetime.timedelta(minutes=args.tick)))
+
+
+if __name__ == '__main__':
+    cli()
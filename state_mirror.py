@@ -0,0 +1,306 @@
+import contextlib
+import datetime
+import logging
+import threading
+from dataclasses import replace
+from typing import Dict, List, Optional, Tuple
+
+import db
+from config import *
+from models.accounts import Plan
+from models.orders import LedgerEntry, Order, OrderOutcome, ScheduledOrder
+from utils import *
+
+__all__ = [
+    'PlanStore',
+    'StateMirror',
+    'WriteBatch',
+]
+
+
+# Scheduled orders, leftovers and state of a single plan, stored in the DB.
+class PlanStore:
+    def __init__(self, plan: Plan):
+        self.plan = plan
+
+    def scheduled_orders(self) -> List[ScheduledOrder]:
+        return db.scheduled_orders(self.plan)
+
+    def scheduled_orders_to_execute(self) -> List[ScheduledOrder]:
+        return db.scheduled_orders_to_execute(self.plan)
+
+    def next_order_scheduled_for(self) -> Optional[datetime.datetime]:
+        return db.next_order_scheduled_for(self.plan)
+
+    def leftovers(self, ticker: str) -> float:
+        return db.leftovers(self.plan, ticker)
+
+    def all_leftovers(self) -> Dict[str, float]:
+        return db.all_leftovers(self.plan)
+
+    def state(self) -> List[Tuple[str, str]]:
+        return db.state(self.plan)
+
+    def ledger(self) -> Dict[str, LedgerEntry]:
+        return db.ledger(self.plan)
+
+    def put_scheduled_orders(self, *orders: ScheduledOrder):
+        db.put_scheduled_orders(self.plan, *orders)
+
+    def drop_scheduled_orders(self):
+        db.drop_scheduled_orders(self.plan)
+
+    def drop_expired_scheduled_orders(self):
+        db.drop_expired_scheduled_orders(self.plan)
+
+    def delete_scheduled_order(self, order: ScheduledOrder):
+        db.delete_scheduled_order(self.plan, order)
+
+    def replace_scheduled_orders(self, deleted: List[ScheduledOrder], added: List[ScheduledOrder]):
+        db.replace_scheduled_orders(self.plan, deleted, added)
+
+    def extend_schedule(self, orders: List[ScheduledOrder], entries: List[LedgerEntry]):
+        with db.connection() as conn, conn.transaction():
+            db.put_scheduled_orders(self.plan, *orders, conn=conn)
+            db.put_ledger(self.plan, *entries, conn=conn)
+
+    def save_executed_order(self, order: Order, scheduled_order: ScheduledOrder):
+        db.save_executed_order(self.plan, order, scheduled_order)
+
+    def postpone_scheduled_order(self, order: ScheduledOrder):
+        db.postpone_scheduled_order(self.plan, order)
+
+    def save_outcomes(self, outcomes: List[OrderOutcome]):
+        db.save_outcomes(self.plan, outcomes)
+
+    # Scheduled orders and the ledger changed along with the state are replaced
+    # in the same transaction, the ledger is kept if it's None.
+    def update_state(self, state: List[Tuple[str, str]],
+                     deleted: List[ScheduledOrder] = (), added: List[ScheduledOrder] = (),
+                     ledger: Optional[Dict[str, LedgerEntry]] = None):
+        with db.connection() as conn, conn.transaction():
+            db.update_state(self.plan, state, conn=conn)
+            db.replace_scheduled_orders(self.plan, deleted, added, conn=conn)
+            if ledger is not None:
+                db.replace_ledger(self.plan, list(ledger.values()), conn=conn)
+
+
+# In-memory copy of a plan's scheduled_orders, leftovers, state and
+# schedule_ledger rows, which only the main process writes. Reads are answered
+# from memory, writes go to Postgres first and are applied to memory once their
+# transaction commits.
+class StateMirror(PlanStore):
+    def __init__(self, plan: Plan):
+        super().__init__(plan)
+        self._lock = threading.RLock()
+        self._writes = 0
+        self._writes_applied = threading.Condition(self._lock)
+        self._scheduled_orders: Dict[Tuple[str, datetime.datetime], ScheduledOrder] = {}
+        self._leftovers: Dict[str, float] = {}
+        self._state: List[Tuple[str, str]] = []
+        self._ledger: Dict[str, LedgerEntry] = {}
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self._writes_applied.wait_for(lambda: self._writes == 0)
+            with db.connection() as conn, conn.transaction():
+                self._scheduled_orders = {(o.ticker, o.execute_at): o for o in db.scheduled_orders(self.plan, conn=conn)}
+                self._leftovers = db.all_leftovers(self.plan, conn=conn)
+                self._state = db.state(self.plan, conn=conn)
+                self._ledger = db.ledger(self.plan, conn=conn)
+        logging.info('loaded %s scheduled orders and %s leftovers of %s', len(self._scheduled_orders), len(self._leftovers), self.plan.name)
+
+    def verify(self) -> bool:
+        with self._lock:
+            self._writes_applied.wait_for(lambda: self._writes == 0)
+            with db.connection() as conn, conn.transaction():
+                scheduled_orders = {(o.ticker, o.execute_at): o for o in db.scheduled_orders(self.plan, conn=conn)}
+                drifted = [name for name, stored, mirrored in [
+                    ('scheduled_orders', scheduled_orders, self._scheduled_orders),
+                    ('leftovers', db.all_leftovers(self.plan, conn=conn), self._leftovers),
+                    ('state', db.state(self.plan, conn=conn), self._state),
+                    ('schedule_ledger', db.ledger(self.plan, conn=conn), self._ledger),
+                ] if stored != mirrored]
+            if not drifted:
+                return True
+            logging.error('%s state mirror has drifted from the DB in %s, reloading', self.plan.name, ', '.join(drifted))
+        self.load()
+        return False
+
+    # Reads.
+
+    def scheduled_orders(self) -> List[ScheduledOrder]:
+        with self._lock:
+            return sorted(self._scheduled_orders.values(), key=lambda o: (o.execute_at, o.ticker))
+
+    def scheduled_orders_to_execute(self) -> List[ScheduledOrder]:
+        t = now()
+        return [o for o in self.scheduled_orders() if o.execute_at <= t]
+
+    def next_order_scheduled_for(self) -> Optional[datetime.datetime]:
+        with self._lock:
+            return min((o.execute_at for o in self._scheduled_orders.values()), default=None)
+
+    def leftovers(self, ticker: str) -> float:
+        with self._lock:
+            return self._leftovers.get(ticker, 0.0)
+
+    def all_leftovers(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._leftovers)
+
+    def state(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._state)
+
+    def ledger(self) -> Dict[str, LedgerEntry]:
+        with self._lock:
+            return {ticker: replace(e) for ticker, e in self._ledger.items()}
+
+    # Writes. The DB is written outside the lock, which is only taken to apply
+    # the committed change, loads wait for the writes in progress.
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock:
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._writes -= 1
+                self._writes_applied.notify_all()
+
+    def put_scheduled_orders(self, *orders: ScheduledOrder):
+        with self._writing():
+            super().put_scheduled_orders(*orders)
+            with self._lock:
+                self._scheduled_orders.update({(o.ticker, o.execute_at): o for o in orders})
+
+    def drop_scheduled_orders(self):
+        with self._writing():
+            super().drop_scheduled_orders()
+            with self._lock:
+                self._scheduled_orders = {}
+                self._ledger = {}
+
+    def drop_expired_scheduled_orders(self):
+        before = now() - self.plan.investment_period
+        with self._writing():
+            db.drop_expired_scheduled_orders(self.plan, before)
+            with self._lock:
+                self._scheduled_orders = {k: o for k, o in self._scheduled_orders.items() if o.execute_at >= before}
+
+    def delete_scheduled_order(self, order: ScheduledOrder):
+        with self._writing():
+            super().delete_scheduled_order(order)
+            with self._lock:
+                self._scheduled_orders.pop((order.ticker, order.execute_at), None)
+
+    def replace_scheduled_orders(self, deleted: List[ScheduledOrder], added: List[ScheduledOrder]):
+        with self._writing():
+            super().replace_scheduled_orders(deleted, added)
+            with self._lock:
+                self._replace(deleted, added)
+
+    def extend_schedule(self, orders: List[ScheduledOrder], entries: List[LedgerEntry]):
+        with self._writing():
+            super().extend_schedule(orders, entries)
+            with self._lock:
+                self._replace([], orders)
+                self._ledger.update({e.ticker: replace(e) for e in entries})
+
+    def save_executed_order(self, order: Order, scheduled_order: ScheduledOrder):
+        with self._writing():
+            super().save_executed_order(order, scheduled_order)
+            with self._lock:
+                self._apply(OrderOutcome(scheduled_order, order=order))
+
+    def postpone_scheduled_order(self, order: ScheduledOrder):
+        with self._writing():
+            super().postpone_scheduled_order(order)
+            with self._lock:
+                self._apply(OrderOutcome(order, postponed=True))
+
+    def save_outcomes(self, outcomes: List[OrderOutcome]):
+        with self._writing():
+            super().save_outcomes(outcomes)
+            with self._lock:
+                for outcome in outcomes:
+                    self._apply(outcome)
+
+    def update_state(self, state: List[Tuple[str, str]],
+                     deleted: List[ScheduledOrder] = (), added: List[ScheduledOrder] = (),
+                     ledger: Optional[Dict[str, LedgerEntry]] = None):
+        with self._writing():
+            super().update_state(state, deleted, added, ledger)
+            with self._lock:
+                self._state = sorted(state)
+                self._replace(deleted, added)
+                if ledger is not None:
+                    self._ledger = {ticker: replace(e) for ticker, e in ledger.items()}
+
+    def _apply(self, outcome: OrderOutcome):
+        o = outcome.scheduled_order
+        self._scheduled_orders.pop((o.ticker, o.execute_at), None)
+        if outcome.order is not None:
+            self._leftovers.pop(o.ticker, None)
+        elif outcome.postponed and o.amount:
+            self._leftovers[o.ticker] = self._leftovers.get(o.ticker, 0.0) + o.amount
+
+    def _replace(self, deleted: List[ScheduledOrder], added: List[ScheduledOrder]):
+        for o in deleted:
+            self._scheduled_orders.pop((o.ticker, o.execute_at), None)
+        self._scheduled_orders.update({(o.ticker, o.execute_at): o for o in added})
+
+
+# Postponed and deleted scheduled orders, written to a plan store in one
+# transaction on commit. Until then leftovers are answered as if the outcomes
+# were written. Executed orders are written right away, together with the
+# buffered outcomes of their ticker, so an executed order is durable as soon as
+# it's saved. Used by several order execution threads at once, orders of the
+# same ticker come from one thread.
+class WriteBatch:
+    def __init__(self, store: PlanStore):
+        self.store = store
+        self._lock = threading.Lock()
+        self._outcomes: List[OrderOutcome] = []
+        self._leftovers: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._outcomes)
+
+    def leftovers(self, ticker: str) -> float:
+        with self._lock:
+            if ticker in self._leftovers:
+                return self._leftovers[ticker]
+        return self.store.leftovers(ticker)
+
+    def save_executed_order(self, order: Order, scheduled_order: ScheduledOrder):
+        ticker = scheduled_order.ticker
+        with self._lock:
+            buffered = [outcome for outcome in self._outcomes if outcome.scheduled_order.ticker == ticker]
+        self.store.save_outcomes(buffered + [OrderOutcome(scheduled_order, order=order)])
+        with self._lock:
+            self._outcomes = [outcome for outcome in self._outcomes if outcome.scheduled_order.ticker != ticker]
+            self._leftovers.pop(ticker, None)
+
+    def postpone_scheduled_order(self, order: ScheduledOrder):
+        leftovers = self.leftovers(order.ticker)
+        with self._lock:
+            self._outcomes.append(OrderOutcome(order, postponed=True))
+            self._leftovers[order.ticker] = leftovers + order.amount
+
+    def delete_scheduled_order(self, order: ScheduledOrder):
+        with self._lock:
+            self._outcomes.append(OrderOutcome(order))
+
+    def commit(self):
+        # Outcomes are dropped whether the commit succeeds or not, their
+        # scheduled orders are executed again if it fails.
+        with self._lock:
+            outcomes, self._outcomes, self._leftovers = self._outcomes, [], {}
+        if outcomes:
+            self.store.save_outcomes(outcomes)
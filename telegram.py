@@ -1,13 +1,26 @@
+import atexit
+import datetime
+import hashlib
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List
+
 import telebot
+from telebot import apihelper
 from telebot.formatting import hbold
 from telebot.types import Message
 
 import db
+import transport
 from config import *
 from utils import *
 
 __all__ = [
     'bot',
+    'Notifier',
     'send_message',
 ]
 
@@ -20,15 +33,119 @@ class IsAdminFilter(telebot.custom_filters.SimpleCustomFilter):
         return message.from_user.id == TELEGRAM_USER
 
 
-bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode='HTML')
+apihelper.CUSTOM_REQUEST_SENDER = transport.new_session().request
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+
+TELEGRAM_USER = int(read_secret('telegram_user'))
+
+bot = telebot.TeleBot(read_secret('telegram_token'), parse_mode='HTML')
 bot.add_custom_filter(IsAdminFilter())
 
 
+# Telegram's limit on the length of a message.
+MAX_MESSAGE_LENGTH = 4096
+
+
+class Notifier:
+    # Sends notifications from a background thread, so callers never wait for
+    # Telegram or the DB. A text already sent in the last hour is dropped, at
+    # most MAX_MESSAGES_PER_HOUR messages are sent per hour, and notifications
+    # queued within NOTIFICATION_BATCH_WINDOW are sent as one message. Sent
+    # texts are recorded in the DB, so the limits hold across restarts.
+
+    def __init__(self, send: Callable[[str], None], maxsize: int = 100):
+        self._send = send
+        self._queue: queue.Queue[str] = queue.Queue(maxsize=maxsize)
+        self._sent: Dict[str, datetime.datetime] = {}  # text digest -> sent at
+        self._sent_at: Deque[datetime.datetime] = deque()  # messages sent in the last hour
+        self._lock = threading.Lock()
+        self._started = False
+
+    def notify(self, text: str):
+        self._start()
+        try:
+            self._queue.put_nowait(text)
+        except queue.Full:
+            logging.warning('notification queue is full, dropping: %s', text)
+
+    def flush(self, timeout: float = 10):
+        # Waits for queued notifications to be sent, e.g. before exiting.
+        with self._queue.all_tasks_done:
+            self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._drain, name='notifier', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _drain(self):
+        try:
+            for text, sent_at in sorted(db.sent_messages(now() - datetime.timedelta(hours=1)), key=lambda m: m[1]):
+                self._sent[_digest(text)] = sent_at
+                if sent_at not in self._sent_at:
+                    self._sent_at.append(sent_at)
+        except Exception:
+            logging.exception('failed to load sent messages')
+
+        while True:
+            texts = [self._queue.get()]
+            deadline = time.monotonic() + NOTIFICATION_BATCH_WINDOW.total_seconds()
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    texts.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._send_batch(texts)
+            except Exception:
+                logging.exception('failed to send notifications')
+            finally:
+                for _ in texts:
+                    self._queue.task_done()
+
+    def _send_batch(self, texts: List[str]):
+        t = now()
+        for digest in [d for d, sent_at in self._sent.items() if t - sent_at > datetime.timedelta(hours=1)]:
+            del self._sent[digest]
+        while self._sent_at and t - self._sent_at[0] > datetime.timedelta(hours=1):
+            self._sent_at.popleft()
+
+        fresh = {}
+        for text in texts:
+            if (digest := _digest(text)) not in self._sent:
+                fresh.setdefault(digest, text)
+
+        # Several notifications per message, as long as they fit.
+        messages: List[List[str]] = []
+        for text in fresh.values():
+            if messages and len('\n\n'.join(messages[-1] + [text])) <= MAX_MESSAGE_LENGTH:
+                messages[-1].append(text)
+            else:
+                messages.append([text])
+
+        for message in messages:
+            if len(self._sent_at) >= MAX_MESSAGES_PER_HOUR:
+                logging.warning('message limit is reached, dropping %s notifications', len(message))
+                continue
+            self._send('\n\n'.join(message))
+            t = now()
+            self._sent_at.append(t)
+            self._sent.update({_digest(text): t for text in message})
+            db.record_messages(message, t)
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+_notifier = Notifier(lambda text: bot.send_message(TELEGRAM_USER, text))
+
+
 def send_message(text: str):
-    if not db.can_send_message(text):
-        return
-    bot.send_message(TELEGRAM_USER, text)
-    db.record_message(text)
+    _notifier.notify(text)
 
 
 @bot.message_handler(is_admin=True, commands=['start'])
@@ -0,0 +1,145 @@
+import re
+import threading
+import time
+from dataclasses import dataclass, fields
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import *
+
+__all__ = [
+    'EndpointStats',
+    'InstrumentedSession',
+    'new_session',
+    'record',
+    'record_retry',
+    'aiohttp_trace_config',
+    'stats',
+    'summary',
+]
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    errors: int = 0
+    retries: int = 0
+    new_connections: int = 0
+    seconds_total: float = 0.0
+    seconds_max: float = 0.0
+    bytes_total: int = 0
+
+    @property
+    def seconds_avg(self) -> float:
+        return self.seconds_total / self.requests if self.requests else 0.0
+
+
+_lock = threading.Lock()
+_stats: Dict[str, EndpointStats] = {}
+
+_ID_RE = re.compile(r'/\d+(?=/|$)')
+_BOT_TOKEN_RE = re.compile(r'/bot[^/]+')
+
+
+def endpoint(method: str, url: str) -> str:
+    parts = urlsplit(url)
+    path = _BOT_TOKEN_RE.sub('/bot{token}', _ID_RE.sub('/{id}', parts.path))
+    return f'{method.upper()} {parts.hostname}{path}'
+
+
+def record(endpoint_name: str, seconds: float, size: int = 0, error: bool = False, new_connection: bool = False):
+    with _lock:
+        s = _stats.setdefault(endpoint_name, EndpointStats())
+        s.requests += 1
+        s.errors += error
+        s.new_connections += new_connection
+        s.seconds_total += seconds
+        s.seconds_max = max(s.seconds_max, seconds)
+        s.bytes_total += size
+
+
+def record_retry(retry_state):
+    # Tenacity before_sleep hook, failed attempts are attributed to the request that failed.
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    if (request := getattr(exc, 'request', None)) is not None and getattr(request, 'url', None):
+        name = endpoint(request.method, request.url)
+    elif (request_info := getattr(exc, 'request_info', None)) is not None:
+        name = endpoint(request_info.method, str(request_info.url))
+    else:
+        name = f'CALL {retry_state.fn.__qualname__}'
+    with _lock:
+        _stats.setdefault(name, EndpointStats()).retries += 1
+
+
+# Keep-alive connections are pooled per host and shared by every session.
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+
+
+class InstrumentedSession(requests.Session):
+    def __init__(self):
+        super().__init__()
+        self.mount('https://', _adapter)
+        self.mount('http://', _adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        name = endpoint(method, url)
+        pool = _adapter.poolmanager.connection_from_url(url)
+        connections = pool.num_connections
+        started = time.perf_counter()
+        try:
+            r = super().request(method, url, *args, **kwargs)
+        except Exception:
+            record(name, time.perf_counter() - started, error=True, new_connection=pool.num_connections > connections)
+            raise
+        record(name, time.perf_counter() - started, size=len(r.content), error=r.status_code >= 400,
+               new_connection=pool.num_connections > connections)
+        return r
+
+
+def new_session() -> InstrumentedSession:
+    return InstrumentedSession()
+
+
+def aiohttp_trace_config() -> aiohttp.TraceConfig:
+    async def on_request_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+        ctx.new_connection = False
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.new_connection = True
+
+    async def on_request_end(session, ctx, params):
+        record(endpoint(params.method, str(params.url)), time.perf_counter() - ctx.started,
+               size=params.response.content_length or 0, error=params.response.status >= 400,
+               new_connection=ctx.new_connection)
+
+    async def on_request_exception(session, ctx, params):
+        record(endpoint(params.method, str(params.url)), time.perf_counter() - ctx.started,
+               error=True, new_connection=ctx.new_connection)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+def stats() -> Dict[str, EndpointStats]:
+    with _lock:
+        return {k: EndpointStats(**{f.name: getattr(v, f.name) for f in fields(v)}) for k, v in _stats.items()}
+
+
+def summary(limit: Optional[int] = None) -> str:
+    lines = []
+    for name, s in sorted(stats().items(), key=lambda x: -x[1].seconds_total)[:limit]:
+        lines.append(f'{name}: {s.requests} requests, {s.errors} errors, {s.retries} retries, '
+                     f'{s.new_connections} new connections, avg {s.seconds_avg:.3f}s, max {s.seconds_max:.3f}s, '
+                     f'{s.bytes_total / 1024:.1f} KiB')
+    return '\n'.join(lines)
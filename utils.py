@@ -1,16 +1,17 @@
 import datetime
-import functools
-import json
 import logging
-from dataclasses import dataclass
-from typing import Any, Optional, List, Tuple
+import os
+from typing import List, Tuple
 
 from config import *
+from models.accounts import Account, Plan
 
 __all__ = [
     'setup_logging',
+    'read_secret',
+    'Clock',
+    'set_clock',
     'now',
-    'cached_method',
     'build_state',
 ]
 
@@ -18,7 +19,7 @@ __all__ = [
 def setup_logging(level=logging.INFO, filename='autoinvest.log'):
     logging.basicConfig(
         level=level,
-        format='[%(name)s\t%(levelname)s\t%(asctime)s]\t%(message)s',
+        format='[%(name)s\t%(threadName)s\t%(levelname)s\t%(asctime)s]\t%(message)s',
         handlers=[
             logging.StreamHandler(),
             logging.FileHandler(filename),
@@ -26,43 +27,37 @@ def setup_logging(level=logging.INFO, filename='autoinvest.log'):
     )
 
 
-def now():
-    return datetime.datetime.now(tz=TIMEZONE)
+# Process-wide secrets, read when needed rather than on import.
+def read_secret(name: str) -> str:
+    with open(os.path.join('.secrets', name), 'r') as f:
+        return f.read().strip()
 
 
-@dataclass
-class CacheObject:
-    value: Any
-    cached_at: datetime.datetime
+class Clock:
+    # Wall clock, simulations replace it with a virtual one.
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(tz=TIMEZONE)
 
 
-def cached_method(ttl: Optional[datetime.timedelta] = None):
-    def wrapper(func):
-        @functools.wraps(func)
-        def wrapped(self, *args, **kwargs):
-            key = json.dumps({
-                'func': func.__name__,
-                'args': [repr(x) for x in args],
-                'kwargs': {k: repr(v) for k, v in kwargs.items()},
-            }, sort_keys=True)
-            if not hasattr(self, '__method_cache'):
-                self.__method_cache = {}
-            if key not in self.__method_cache or (ttl and now() - self.__method_cache[key].cached_at > ttl):
-                value = func(self, *args, **kwargs)
-                self.__method_cache[key] = CacheObject(value, now())
-            return self.__method_cache[key].value
+_clock = Clock()
 
-        return wrapped
 
-    return wrapper
+def set_clock(clock: Clock) -> Clock:
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
 
 
-def build_state(pie_composition: List[Tuple[str, float]]) -> List[Tuple[str, str]]:
+def now() -> datetime.datetime:
+    return _clock.now()
+
+
+def build_state(account: Account, plan: Plan, pie_composition: List[Tuple[str, float]]) -> List[Tuple[str, str]]:
     return sorted([
-        ('mode', MODE.name),
-        ('pie_name', AUTOINVEST_PIE),
+        ('mode', account.mode.name),
+        ('pie_name', plan.pie),
         ('pie_composition', str(pie_composition)),
-        ('master_currency', MASTER_CURRENCY),
-        ('weekly_amount', str(WEEKLY_AMOUNT)),
-        ('investment_period', str(INVESTMENT_PERIOD))
+        ('master_currency', plan.master_currency),
+        ('weekly_amount', str(plan.weekly_amount)),
+        ('investment_period', str(plan.investment_period))
     ], key=lambda x: x[0])
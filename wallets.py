@@ -0,0 +1,57 @@
+import datetime
+import logging
+import threading
+from typing import Dict, Optional
+
+from config import *
+from utils import *
+
+__all__ = [
+    'Wallets',
+    'parse_funds',
+]
+
+
+def parse_funds(r: dict) -> Optional[Dict[str, float]]:
+    # Funds are reported per trading account, possibly one per currency wallet.
+    if not isinstance(r, dict) or r.get('code'):
+        return None
+    free = {}
+    for account in r.values():
+        if isinstance(account, dict) and 'currency' in account and 'freeForStocks' in account:
+            free[account['currency']] = free.get(account['currency'], 0.0) + account['freeForStocks']
+    return free or None
+
+
+# Snapshot of free cash per currency wallet. It is decremented locally as
+# orders go through and only trusted for WALLETS_MAX_AGE, after that orders
+# fall back to trying every currency until one succeeds.
+class Wallets:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free: Dict[str, float] = {}
+        self._updated_at: Optional[datetime.datetime] = None
+
+    def fresh(self) -> bool:
+        return self._updated_at is not None and now() - self._updated_at < WALLETS_MAX_AGE
+
+    def update(self, free: Dict[str, float]):
+        with self._lock:
+            self._free = dict(free)
+            self._updated_at = now()
+        logging.info('free funds: %s', ', '.join(f'{v:.2f} {k}' for k, v in sorted(free.items())))
+
+    def can_afford(self, currency: str, value: float) -> bool:
+        with self._lock:
+            if not self.fresh():
+                return True
+            return self._free.get(currency, 0.0) >= value
+
+    def spend(self, currency: str, value: float):
+        with self._lock:
+            if currency in self._free:
+                self._free[currency] -= value
+
+    def exhaust(self, currency: str):
+        with self._lock:
+            self._free[currency] = 0.0
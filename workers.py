@@ -0,0 +1,532 @@
+import ast
+import asyncio
+import datetime
+import logging
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telebot.formatting import hbold, hpre
+
+import db
+import metrics
+import transport
+from api_client import T212ApiClient
+from async_clients import *
+from cache import Cache
+from config import *
+from equity_client import *
+from models.accounts import Plan
+from models.orders import LedgerEntry, Order, ScheduledOrder
+from models.pies import Pie
+from pending_orders import PendingOrderTracker
+from scheduler import *
+from state_mirror import PlanStore, StateMirror, WriteBatch
+from utils import *
+
+__all__ = [
+    'Worker',
+    'OrderExecution',
+    'PieWatcher',
+    'Waker',
+    'update_state',
+    'update_schedule',
+    'run',
+    'execute_due_orders',
+    'execute_due_orders_async',
+    'main_loop',
+]
+
+
+class Worker:
+    # Autoinvests into a single plan's pie in its own main loop thread. Every
+    # worker has its own store, pie watcher and waker, clients are shared by
+    # all plans of the same account. Notifications go through send_message.
+
+    def __init__(self, plan: Plan, equity: EquityClient, api_client: T212ApiClient,
+                 send_message: Callable[[str], None], store: Optional[PlanStore] = None):
+        self.plan = plan
+        self.equity = equity
+        self.api_client = api_client
+        self.send_message = send_message
+        self.store = store or (StateMirror(plan) if STATE_MIRROR else PlanStore(plan))
+        # Order outcomes are written through here, postponed and skipped orders
+        # are committed once per tick with GROUP_COMMIT.
+        self.writes = WriteBatch(self.store) if GROUP_COMMIT else self.store
+        self.waker = Waker()
+        self.watcher = PieWatcher(self, on_scheduled=self.waker.wake_up)
+        # Largest order amount per ticker rejected as too small.
+        self.rejected_amounts: Cache[str, float] = Cache(f'Worker.rejected_amounts.{plan.name}', ttl=REJECTED_AMOUNT_MAX_AGE)
+        self.error: Optional[BaseException] = None
+
+    def notify(self, text: str):
+        self.send_message(f'{hbold(self.plan.name)}: {text}' if len(PLANS) > 1 else text)
+
+    def stage(self, name: str):
+        return metrics.timed('autoinvest_tick_stage_seconds', plan=self.plan.name, stage=name)
+
+    def count_order(self, o: ScheduledOrder, outcome: str):
+        metrics.inc('autoinvest_orders_total', plan=self.plan.name, ticker=o.ticker, outcome=outcome)
+
+    def start(self, tick: Callable[['Worker'], None], on_stop: Callable[[], None]):
+        def loop():
+            try:
+                main_loop(self, tick)
+            except BaseException as e:
+                self.error = e
+            finally:
+                on_stop()
+
+        self.watcher.start()
+        threading.Thread(target=loop, name=self.plan.name, daemon=True).start()
+
+
+class OrderExecution:
+    # Handles the outcome of executing a scheduled order: saving it, postponing
+    # smol orders and disabling autoinvest if an executed order wasn't saved.
+
+    def __init__(self, worker: Worker, o: ScheduledOrder, amount: float, pending: PendingOrderTracker):
+        self.worker = worker
+        self.o = o
+        self.amount = amount
+        self.pending = pending
+        self.executed = False
+        self.saved = False
+
+    def __enter__(self) -> 'OrderExecution':
+        return self
+
+    async def __aenter__(self) -> 'OrderExecution':
+        return self
+
+    # Store writes block, so the outcome is handled in a worker thread.
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> bool:
+        return await asyncio.to_thread(self.__exit__, exc_type, exc_val, exc_tb)
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        o = self.o
+        try:
+            if exc_type is not None and issubclass(exc_type, SmolOrderException):
+                logging.info('order amount is too small, postponing')
+                rejected = self.worker.rejected_amounts.get_fresh(o.ticker) or 0.0
+                self.worker.rejected_amounts.put(o.ticker, max(rejected, self.amount))
+                self.worker.writes.postpone_scheduled_order(o)
+                self.worker.count_order(o, 'postponed')
+                return True
+            if exc_type is not None and issubclass(exc_type, InsufficientFundsException):
+                logging.info('account balance is insufficient, skipping order')
+                self.worker.notify('Account balance is insufficient to execute new orders.')
+                self.worker.writes.delete_scheduled_order(o)
+                self.worker.count_order(o, 'skipped')
+                return True
+            if exc_type is not None:
+                # Not sure whether the order went through.
+                self.pending.mark_inconsistent()
+                self.worker.count_order(o, 'failed')
+            return False
+        finally:
+            if self.executed and not self.saved:
+                logging.error('failed to save executed %s order, disabling autoinvest to avoid uncontrolled spendings', o.ticker)
+                self.worker.notify(f'Failed to save executed {o.ticker} order, disabling autoinvest to avoid uncontrolled spendings.')
+                db.disable()
+
+    def save(self, order: Order):
+        self.executed = True
+        self.worker.writes.save_executed_order(order, self.o)
+        self.saved = True
+        if (self.worker.rejected_amounts.peek(self.o.ticker) or 0.0) >= self.amount:
+            self.worker.rejected_amounts.invalidate(self.o.ticker)
+        self.worker.count_order(self.o, 'executed')
+        logging.info('executed using %s %s', order.amount, order.currency)
+
+
+def has_pending_orders(worker: Worker, o: ScheduledOrder, pending_orders: List[Order]) -> bool:
+    if not pending_orders:
+        return False
+    logging.error('%s still has some pending orders: %s', o.ticker, pending_orders)
+    worker.notify(f'{o.ticker} still has some pending orders created at ' +
+                  hpre(', '.join(po.created_at.astimezone(TIMEZONE).strftime('%Y-%m-%d %H:%M:%S') for po in pending_orders)))
+    worker.writes.postpone_scheduled_order(o)
+    worker.count_order(o, 'pending')
+    return True
+
+
+def below_min_amount(worker: Worker, o: ScheduledOrder, amount: float) -> bool:
+    # Amounts not larger than a recently rejected one are postponed without
+    # asking T212.
+    rejected = worker.rejected_amounts.get_fresh(o.ticker)
+    if rejected is None or amount > rejected:
+        return False
+    logging.info('order amount is below %s rejected recently, postponing', rejected)
+    worker.writes.postpone_scheduled_order(o)
+    worker.count_order(o, 'postponed')
+    return True
+
+
+def order_amount(worker: Worker, o: ScheduledOrder) -> float:
+    amount = round(o.amount + worker.writes.leftovers(o.ticker), 2)
+    lag = (now() - o.execute_at).total_seconds()
+    metrics.observe('autoinvest_execution_lag_seconds', lag, plan=worker.plan.name)
+    logging.info('executing order for %s: %s %s, %.1fs after scheduled time',
+                 o.ticker, amount, worker.plan.master_currency, lag)
+    return amount
+
+
+# State keys whose changes only touch the affected tickers' orders, any other
+# change reschedules the whole week.
+RESCALABLE_STATE = {'pie_composition', 'weekly_amount'}
+
+
+def update_state(worker: Worker, pie: Pie) -> bool:
+    pie_composition = sorted([(inst.ticker, inst.expected_share) for inst in pie.instruments])
+    state = build_state(worker.equity.account, worker.plan, pie_composition)
+    if (previous := worker.store.state()) == state:
+        return False
+    logging.info('state has changed, updating')
+    worker.store.update_state(state, *state_changes(worker, dict(previous), dict(state)))
+    return True
+
+
+def state_changes(worker: Worker, previous: Dict[str, str], state: Dict[str, str]
+                  ) -> Tuple[List[ScheduledOrder], List[ScheduledOrder], Dict[str, LedgerEntry]]:
+    # Orders of new tickers are generated by the next schedule update.
+    scheduled_orders = worker.store.scheduled_orders()
+    if not previous or any(previous.get(k) != v for k, v in state.items() if k not in RESCALABLE_STATE):
+        logging.info('plan has changed, rescheduling the week')
+        return scheduled_orders, [], {}
+
+    deleted, added, ledger = rescale_orders(scheduled_orders, worker.store.ledger(),
+                                            weekly_amounts(previous), weekly_amounts(state))
+    logging.info('rescheduling %s orders', len(deleted) + len(added))
+    return deleted, added, ledger
+
+
+def weekly_amounts(state: Dict[str, str]) -> Dict[str, float]:
+    weekly_amount = float(state['weekly_amount'])
+    return {ticker: weekly_amount * share for ticker, share in ast.literal_eval(state['pie_composition'])}
+
+
+def update_schedule(worker: Worker, pie: Pie):
+    store = worker.store
+
+    # Validate scheduled order in case market open times have changed.
+    store.drop_expired_scheduled_orders()
+    pie_instruments = collect_instruments(worker.api_client, pie)
+    for inst in pie_instruments:
+        if (rejected := worker.rejected_amounts.get_fresh(inst.ticker)) is not None:
+            inst.min_order_amount = max(inst.min_order_amount, round(rejected + 0.01, 2))
+    if not validate_orders(pie_instruments, scheduled_orders := store.scheduled_orders()):
+        logging.info('some orders scheduled when market is closed, moving them')
+        store.replace_scheduled_orders(*move_closed_orders(pie_instruments, scheduled_orders))
+
+    # Orders scheduled before the ledger existed are accounted for once.
+    ledger = store.ledger()
+    unaccounted = [inst for inst in pie_instruments if inst.ticker not in ledger]
+    if unaccounted and (seeded := seed_ledger(unaccounted, store.scheduled_orders(), worker.plan.weekly_amount)):
+        logging.info('seeding ledger of %s tickers from scheduled orders', len(seeded))
+        store.extend_schedule([], seeded)
+        ledger.update({e.ticker: e for e in seeded})
+
+    # Generating orders for the lookahead window.
+    orders, entries = extend_schedule(pie_instruments, ledger, worker.plan.weekly_amount,
+                                      worker.plan.investment_period, now() + SCHEDULE_LOOKAHEAD, worker.plan.name)
+    if entries:
+        logging.info('scheduling %s new orders', len(orders))
+        store.extend_schedule(orders, entries)
+
+
+def run(worker: Worker):
+    # All stages in one go, the main loop runs them on separate cadences.
+    with worker.stage('find_pie'):
+        pie = worker.api_client.find_pie(worker.plan.pie)
+    if not pie:
+        logging.warning('"%s" pie is not found', worker.plan.pie)
+        return
+    with worker.stage('update_state'):
+        update_state(worker, pie)
+    with worker.stage('update_schedule'):
+        update_schedule(worker, pie)
+
+    with worker.stage('execute_orders'):
+        execute_orders(worker, worker.store.scheduled_orders_to_execute())
+
+
+class PieWatcher:
+    # Polls the pie composition every PIE_CHECK_INTERVAL and checks the schedule
+    # when the composition or metadata changes, every SCHEDULE_CHECK_INTERVAL,
+    # or when poked because no orders are left. Runs in the background so that
+    # order execution never waits for it.
+
+    def __init__(self, worker: Worker, on_scheduled: Callable[[], None]):
+        self._worker = worker
+        self._on_scheduled = on_scheduled
+        self._poked = threading.Event()
+        self._fingerprint = None
+        self._metadata_version = None
+        self._schedule_checked_at: Optional[datetime.datetime] = None
+        self._fetch_pie: Callable[[], Optional[Pie]] = lambda: fetch_pie(worker)
+        self.error: Optional[BaseException] = None
+
+    def use_async(self, api_client: AsyncT212ApiClient, loop: asyncio.AbstractEventLoop):
+        self._fetch_pie = lambda: asyncio.run_coroutine_threadsafe(fetch_pie_async(self._worker, api_client), loop).result()
+
+    def start(self):
+        threading.Thread(target=self._watch, name=f'{self._worker.plan.name}/pie-watcher', daemon=True).start()
+
+    def poke(self):
+        self._poked.set()
+
+    def check(self):
+        worker = self._worker
+        if not (pie := self._fetch_pie()):
+            logging.warning('"%s" pie is not found', worker.plan.pie)
+            return
+
+        changed = False
+        if (fingerprint := pie_fingerprint(pie)) != self._fingerprint:
+            with worker.stage('update_state'):
+                changed = update_state(worker, pie)
+            self._fingerprint = fingerprint
+        if (metadata_version := worker.api_client.metadata_version()) != self._metadata_version:
+            changed = True
+            self._metadata_version = metadata_version
+
+        poked = self._poked.is_set()
+        self._poked.clear()
+        if changed or poked or self._schedule_checked_at is None or \
+                now() - self._schedule_checked_at >= SCHEDULE_CHECK_INTERVAL:
+            with worker.stage('update_schedule'):
+                if isinstance(worker.store, StateMirror):
+                    worker.store.verify()
+                update_schedule(worker, pie)
+            self._schedule_checked_at = now()
+            self._on_scheduled()
+
+    def _watch(self):
+        while True:
+            if db.enabled():
+                try:
+                    self.check()
+                except Exception as e:
+                    logging.error('unexpected error checking pie: %s', traceback.format_exc())
+                    self._worker.notify(f'Unexpected error checking pie:\n{hpre(traceback.format_exc())}')
+                    self.error = e
+                    return
+            self._poked.wait(PIE_CHECK_INTERVAL.total_seconds())
+
+
+def fetch_pie(worker: Worker) -> Optional[Pie]:
+    with worker.stage('find_pie'):
+        pie = worker.api_client.find_pie(worker.plan.pie)
+    if pie:
+        # Refreshes metadata in the background once it's stale.
+        with worker.stage('metadata'):
+            worker.api_client.get_working_schedules()
+            worker.api_client.get_instrument_info()
+    return pie
+
+
+async def fetch_pie_async(worker: Worker, api_client: AsyncT212ApiClient) -> Optional[Pie]:
+    # Pie and metadata don't depend on each other.
+    with worker.stage('find_pie'):
+        pie, _, _ = await asyncio.gather(
+            api_client.find_pie(worker.plan.pie),
+            api_client.get_working_schedules(),
+            api_client.get_instrument_info(),
+        )
+    return pie
+
+
+def pie_fingerprint(pie: Pie) -> int:
+    return hash(tuple(sorted((inst.ticker, inst.expected_share) for inst in pie.instruments)))
+
+
+def execute_due_orders(worker: Worker):
+    if worker.watcher.error:
+        raise worker.watcher.error
+    with worker.stage('execute_orders'):
+        execute_orders(worker, worker.store.scheduled_orders_to_execute())
+    if not worker.store.next_order_scheduled_for():
+        worker.watcher.poke()
+
+
+def group_by_ticker(scheduled_orders: List[ScheduledOrder]) -> List[List[ScheduledOrder]]:
+    res = {}
+    for o in sorted(scheduled_orders, key=lambda x: x.execute_at):
+        res.setdefault(o.ticker, []).append(o)
+    return list(res.values())
+
+
+def execute_orders(worker: Worker, scheduled_orders: List[ScheduledOrder]):
+    # Orders of different tickers are executed concurrently, orders of the same
+    # ticker one by one. Remaining orders are skipped after the first failure.
+    failed = threading.Event()
+
+    def execute_ticker_orders(ticker_orders: List[ScheduledOrder]):
+        for o in ticker_orders:
+            if failed.is_set():
+                return
+            try:
+                execute_order(worker, o)
+            except BaseException:
+                failed.set()
+                raise
+
+    groups = group_by_ticker(scheduled_orders)
+    if not groups:
+        return
+    try:
+        with ThreadPoolExecutor(max_workers=min(ORDER_EXECUTION_CONCURRENCY, len(groups)), thread_name_prefix=f'{worker.plan.name}/order') as pool:
+            futures = [pool.submit(execute_ticker_orders, group) for group in groups]
+    finally:
+        commit_outcomes(worker)
+    for f in futures:
+        f.result()
+
+
+def commit_outcomes(worker: Worker):
+    # Postponed and skipped orders that went through are committed even if others failed.
+    if isinstance(batch := worker.writes, WriteBatch):
+        batch.commit()
+
+
+def execute_order(worker: Worker, o: ScheduledOrder):
+    equity = worker.equity
+    amount = order_amount(worker, o)
+    if below_min_amount(worker, o, amount) or has_pending_orders(worker, o, equity.pending_orders_for(o.ticker)):
+        return
+
+    with OrderExecution(worker, o, amount, equity.pending) as execution:
+        execution.save(equity.execute_order(o.ticker, o.currency, amount,
+                                            worker.plan.master_currency, worker.plan.currency_priority))
+
+
+async def execute_due_orders_async(worker: Worker, equity: AsyncEquityClient):
+    if worker.watcher.error:
+        raise worker.watcher.error
+    with worker.stage('execute_orders'):
+        scheduled_orders = await asyncio.to_thread(worker.store.scheduled_orders_to_execute)
+        if scheduled_orders and equity.client.pending.reconcile_due():
+            equity.client.pending.reconcile(await equity.pending_orders())
+        await execute_orders_async(worker, equity, scheduled_orders)
+    if not await asyncio.to_thread(worker.store.next_order_scheduled_for):
+        worker.watcher.poke()
+
+
+async def execute_orders_async(worker: Worker, equity: AsyncEquityClient, scheduled_orders: List[ScheduledOrder]):
+    semaphore = asyncio.Semaphore(ORDER_EXECUTION_CONCURRENCY)
+    failed = asyncio.Event()
+
+    async def execute_ticker_orders(ticker_orders: List[ScheduledOrder]):
+        async with semaphore:
+            for o in ticker_orders:
+                if failed.is_set():
+                    return
+                try:
+                    await execute_order_async(worker, equity, o)
+                except BaseException:
+                    failed.set()
+                    raise
+
+    try:
+        results = await asyncio.gather(
+            *(execute_ticker_orders(group) for group in group_by_ticker(scheduled_orders)),
+            return_exceptions=True,
+        )
+    finally:
+        await asyncio.to_thread(commit_outcomes, worker)
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+
+
+async def execute_order_async(worker: Worker, equity: AsyncEquityClient, o: ScheduledOrder):
+    # Store writes and the mirror lock block, they're kept off the event loop.
+    amount = await asyncio.to_thread(order_amount, worker, o)
+    if await asyncio.to_thread(below_min_amount, worker, o, amount):
+        return
+    if await asyncio.to_thread(has_pending_orders, worker, o, await equity.pending_orders_for(o.ticker)):
+        return
+
+    async with OrderExecution(worker, o, amount, equity.client.pending) as execution:
+        order = await equity.execute_order(o.ticker, o.currency, amount,
+                                           worker.plan.master_currency, worker.plan.currency_priority)
+        await asyncio.to_thread(execution.save, order)
+
+
+class Waker:
+    # Worker loops sleep until their next order or until woken up, either by
+    # Postgres notification (e.g. autoinvest enabled from Telegram), SIGUSR1 or
+    # when new orders are scheduled. One listener wakes up all workers.
+
+    _wakers: List['Waker'] = []
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._wakers.append(self)
+
+    @classmethod
+    def start(cls):
+        threading.Thread(target=cls._listen, name='wake-up-listener', daemon=True).start()
+
+    @classmethod
+    def handle_signals(cls):
+        # Signal handlers can only be installed from the main thread.
+        signal.signal(signal.SIGUSR1, lambda *_: cls.wake_up_all())
+
+    @classmethod
+    def wake_up_all(cls):
+        for waker in cls._wakers:
+            waker.wake_up()
+
+    def wake_up(self):
+        self._event.set()
+
+    def sleep_until(self, t: datetime.datetime):
+        timeout = max((t - now()).total_seconds(), MIN_TICK_INTERVAL.total_seconds())
+        logging.debug('sleeping for %.0fs', timeout)
+        if self._event.wait(timeout):
+            logging.info('woken up')
+        self._event.clear()
+
+    @classmethod
+    def _listen(cls):
+        while True:
+            try:
+                db.listen(db.WAKE_UP_CHANNEL, cls.wake_up_all)
+            except Exception:
+                logging.exception('wake up listener failed, reconnecting')
+                time.sleep(MAX_TICK_INTERVAL.total_seconds())
+
+
+def next_tick_at(worker: Worker) -> datetime.datetime:
+    deadlines = [now() + MAX_TICK_INTERVAL]
+    if next_order_at := worker.store.next_order_scheduled_for():
+        deadlines.append(next_order_at)
+    return min(deadlines)
+
+
+def main_loop(worker: Worker, tick: Callable[[Worker], None]):
+    while True:
+        if db.enabled():
+            started = time.perf_counter()
+            try:
+                tick(worker)
+            except CookiesExpiredException:
+                logging.info('cookies has expired, restarting')
+                return
+            except Exception:
+                logging.error('unexpected error running main loop: %s', traceback.format_exc())
+                worker.notify(f'Unexpected error running main loop:\n{hpre(traceback.format_exc())}')
+                raise
+            elapsed = time.perf_counter() - started
+            metrics.observe('autoinvest_tick_seconds', elapsed, plan=worker.plan.name)
+            if elapsed > SLOW_TICK.total_seconds():
+                logging.warning('main loop tick took %.1fs, HTTP stats:\n%s', elapsed, transport.summary(limit=10))
+        else:
+            worker.store.drop_scheduled_orders()
+
+        worker.waker.sleep_until(next_tick_at(worker))